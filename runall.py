@@ -4,12 +4,373 @@ import sys
 import os
 import subprocess
 import argparse
-import yaml
 import time
-import re
+import tempfile
+import threading
+import concurrent.futures
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tests'))
+import results # pylint: disable=wrong-import-position
+import spec_loader # pylint: disable=wrong-import-position
+import update_cache # pylint: disable=wrong-import-position
+import bench # pylint: disable=wrong-import-position
+import baselines # pylint: disable=wrong-import-position
+import profiler # pylint: disable=wrong-import-position
+import memprofile # pylint: disable=wrong-import-position
+import importprofile # pylint: disable=wrong-import-position
+import shards # pylint: disable=wrong-import-position
+import shard_plan # pylint: disable=wrong-import-position
+import deterministic # pylint: disable=wrong-import-position
+import watch # pylint: disable=wrong-import-position
+
+PYTHON3 = sys.executable
+
+
+class SpecResult(object):
+    """Outcome of running all test types in one yaml spec file"""
+    def __init__(self, spec_file, args, progress=None, benchmark=None):
+        self.spec_file = spec_file
+        self.tests_total = 0
+        self.tests_success = 0
+        self.tests_failure = 0
+        self.sub_success = 0
+        self.sub_failure = 0
+        self.sub_skipped = 0
+        self.failbreak = False
+        self.cancelled = False
+        self.log = [] # buffered stderr lines when running in parallel
+        self.records = [] # per-test records, only kept if a report needs them
+        self.keep_records = bool(args.junit or args.json or args.slowest or args.perf or args.perf_update
+                                 or args.latency_budget or args.memprofile)
+        self.maxrss = None # peak RSS of the test scripts with --memprofile
+        self.imports = [] # (test type, import and startup costs) with --importprofile
+        self.types = [] # outcome of each test type, for the --json report
+        self.done = None # final record of the current test type
+        self.wall_time = 0.0
+        self.progress = progress
+        self.benchmark = benchmark
+
+    def consume(self, line):
+        """Accounts for a line of --jsonl output from a test script as it arrives"""
+        record = results.parse(line)
+        if record is None:
+            return
+        if record.get('event') == 'done':
+            self.done = record
+            # Fetch successes and failures from this spec run, add to total
+            self.sub_success += record['tests'] - record['failed']
+            self.sub_failure += record['failed']
+            self.sub_skipped += record['skipped']
+            if record.get('maxrss') is not None:
+                self.maxrss = max(self.maxrss or 0, record['maxrss'])
+            if record.get('imports') is not None:
+                self.imports.append((record['type'], record['imports']))
+        else:
+            if self.keep_records:
+                self.records.append(record)
+            if self.progress:
+                self.progress.update(record)
+            if self.benchmark and record.get('time') is not None:
+                self.benchmark.add(record['generator'] or record['type'], record['mbox'], record['version'],
+                                   record['time'])
+
+
+class Progress(object):
+    """Live count of tests run across all specs, shown on a terminal"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tests = 0
+        self.failed = 0
+        self.shown = 0
+
+    def update(self, record):
+        with self.lock:
+            self.tests += 1
+            if record['status'] == 'fail':
+                self.failed += 1
+            if time.time() - self.shown > 0.2:
+                self.shown = time.time()
+                sys.stderr.write("\r[%u tests run, %u failed]" % (self.tests, self.failed))
+                sys.stderr.flush()
+
+
+def run_spec(spec_file, args, result, procs=None, stop=None, pool=None):
+    """
+    Runs every test type of a single spec file, collecting the totals in result.
+    If procs is given, the spec is running in a worker thread: child stderr is
+    captured into result.log instead of being passed through, and running
+    children are registered in procs so they can be terminated on --fof.
+    If pool is given, tests are run by its long-lived --inprocess workers.
+    """
+    def log(msg):
+        if procs is None:
+            # Use stderr so appears in correct sequence in logs; flush seems to be necessary for GitHub actions
+            print(msg, file=sys.stderr, flush=True)
+        else:
+            result.log.append(msg)
+
+    started = time.perf_counter()
+    yml = spec_loader.load(spec_file)
+    env = dict(os.environ) # always pass parent environ, but keep overrides local to this spec
+    for test_type in yml:
+        if args.ttype and test_type not in args.ttype:
+            log("Skipping test type %s due to --ttype flag" % test_type)
+            continue
+        if test_type == 'args':
+            # Environment variable override, e.g. MOCK_GMTIME
+            env_ = yml[test_type].get("env", None)
+            if env_:
+                for key, val in env_.items():
+                    env[key] = val
+            continue
+        message_range = None
+        if args.shard:
+            if (spec_file, test_type) not in args.shard_ranges:
+                continue # all of its messages are run by other shards
+            first, last, count = args.shard_ranges[(spec_file, test_type)]
+            if (first, last) != (0, count):
+                message_range = (first, last)
+        if stop is not None and stop.is_set():
+            result.cancelled = True
+            break
+        result.tests_total += 1
+        log("Running '%s' tests from %s..." % (test_type, spec_file))
+        cliargs = [PYTHON3, 'tests/test-%s.py' % test_type, '--rootdir', args.rootdir, '--load', spec_file,]
+        if args.nomboxo:
+            cliargs.append('--nomboxo')
+        if args.gtype and test_type == 'generators':
+            cliargs.append('--generators')
+            cliargs.extend(args.gtype)
+        if args.dropin:
+            cliargs.extend(['--dropin', args.dropin])
+        if args.skipnodate and test_type == 'generators':
+            cliargs.append('--skipnodate')
+        if args.singlepass and test_type == 'generators':
+            cliargs.append('--singlepass')
+        if args.cache and not args.nocache:
+            cliargs.extend(['--cache', args.cache, '--cache-size', str(args.cache_size)])
+        else:
+            cliargs.append('--no-cache')
+        if args.bench:
+            cliargs.extend(['--bench', '--warmup', str(args.warmup), '--repeat', str(args.repeat)])
+        if args.profile:
+            cliargs.extend(['--profile-dir', args.profile_dir])
+        if args.memprofile:
+            cliargs.append('--memprofile')
+        if args.importprofile:
+            cliargs.append('--importprofile')
+        if args.workers > 1:
+            cliargs.extend(['--workers', str(args.workers)])
+        if message_range:
+            cliargs.extend(['--message-range', '%u:%u' % message_range])
+        cliargs.append('--jsonl')
+        if pool is not None and deterministic.hashseed_matches(env):
+            # Archiver is already loaded in the worker; only the test itself runs here
+            returncode, rv, err = pool.submit(inprocess.run_test, test_type, cliargs[2:], env, True).result()
+            if err:
+                result.log.append(err.rstrip('\n'))
+            if stop is not None and stop.is_set():
+                result.tests_total -= 1
+                result.cancelled = True
+                break
+            for line in rv.splitlines():
+                result.consume(line)
+        elif args.inprocess and procs is None and deterministic.hashseed_matches(env):
+            returncode, _, _ = inprocess.run_test(test_type, cliargs[2:], env, on_line=result.consume)
+        else:
+            # Child stderr goes to a file rather than a pipe so reading stdout as it arrives cannot deadlock
+            errfile = tempfile.TemporaryFile() if procs is not None else None
+            proc = subprocess.Popen(cliargs, env=env, stdout=subprocess.PIPE, stderr=errfile,
+                                    universal_newlines=True)
+            if procs is not None:
+                procs.add(proc)
+            try:
+                for line in proc.stdout:
+                    result.consume(line)
+                returncode = proc.wait()
+            finally:
+                if procs is not None:
+                    procs.discard(proc)
+            if errfile:
+                errfile.seek(0)
+                err = errfile.read()
+                errfile.close()
+                if err:
+                    result.log.append(err.decode('utf-8', 'replace').rstrip('\n'))
+            if stop is not None and stop.is_set() and returncode < 0:
+                # Terminated because another spec failed with --fof
+                result.tests_total -= 1
+                result.cancelled = True
+                break
+        done = result.done or {}
+        result.types.append({'spec': spec_file, 'type': test_type, 'returncode': returncode,
+                             'tests': done.get('tests', 0), 'failed': done.get('failed', 0),
+                             'skipped': done.get('skipped', 0)})
+        result.done = None
+        if returncode == 0:
+            result.tests_success += 1
+        else:
+            log("FAIL: %s test from %s failed with code %d" % (test_type, spec_file, returncode))
+            result.tests_failure += 1
+        if returncode != 0 and args.failonfail:
+            result.failbreak = True
+            break
+    result.wall_time = time.perf_counter() - started
+    return result
+
+
+def timed_record(record):
+    return "%8.2f ms  %s %s index %u %s" % (record['time'] * 1000, record['mbox'], record['generator'] or record['type'],
+                                          record['index'], record['message-id'])
+
+
+def spec_selected(spec_file, args):
+    """Does the spec have any tests of the selected types and generators?"""
+    yml = spec_loader.load(spec_file)
+    for test_type, runs in yml.items():
+        if test_type == 'args' or (args.ttype is not None and test_type not in args.ttype):
+            continue
+        if test_type != 'generators' or args.gtype is None:
+            return True
+        if any(gen_type in args.gtype for run in runs.values() if run for gen_type in run):
+            return True
+    return False
+
+
+def run_parallel(spec_files, args, progress, benchmark):
+    """
+    Runs spec files concurrently using a pool of --jobs worker threads, each driving
+    its own test subprocess (or a long-lived worker process with --inprocess).
+    The largest specs are started first so that they do not dominate the tail of the run.
+    Logs are replayed in spec order as soon as a spec and all of its predecessors have
+    finished, so the output is deterministic.
+    """
+    spec_results = [SpecResult(spec_file, args, progress, benchmark) for spec_file in spec_files]
+    procs = set()
+    stop = threading.Event()
+    order = sorted(range(len(spec_files)), key=lambda i: os.path.getsize(spec_files[i]), reverse=True)
+    workers = None
+    if args.inprocess:
+        workers = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, initializer=inprocess.init_worker,
+                                                         initargs=(args.rootdir,))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [None] * len(spec_files)
+        for i in order:
+            futures[i] = pool.submit(run_spec, spec_files[i], args, spec_results[i], procs, stop, workers)
+        printed = 0
+        for future in concurrent.futures.as_completed(futures):
+            if not future.cancelled() and future.result().failbreak and not stop.is_set():
+                stop.set()
+                for f in futures:
+                    f.cancel()
+                for proc in list(procs):
+                    proc.terminate()
+            while printed < len(futures) and futures[printed].done():
+                for line in spec_results[printed].log:
+                    print(line, file=sys.stderr, flush=True)
+                printed += 1
+    if workers is not None:
+        workers.shutdown(cancel_futures=True)
+    return [result for future, result in zip(futures, spec_results) if not future.cancelled() and not result.cancelled]
+
+
+def run_suite(spec_files, args, progress=None):
+    """Runs the spec files and prints the summary and any reports; returns True if the run failed"""
+    now = time.time()
+    if progress is None and args.progress:
+        progress = Progress()
+    benchmark = bench.Bench() if args.bench else None
+    if args.profile:
+        args.profile_dir = tempfile.mkdtemp(prefix='runall-profile-')
+
+    if args.jobs > 1:
+        spec_results = run_parallel(spec_files, args, progress, benchmark)
+    else:
+        spec_results = []
+        for spec_file in spec_files:
+            result = run_spec(spec_file, args, SpecResult(spec_file, args, progress, benchmark))
+            spec_results.append(result)
+            if result.failbreak:
+                break
+    if progress:
+        sys.stderr.write("\n")
+
+    tests_total = sum(r.tests_total for r in spec_results)
+    tests_failure = sum(r.tests_failure for r in spec_results)
+    sub_success = sum(r.sub_success for r in spec_results)
+    sub_failure = sum(r.sub_failure for r in spec_results)
+    sub_skipped = sum(r.sub_skipped for r in spec_results)
+    records = [record for r in spec_results for record in r.records]
+    totals = {'specs': tests_total, 'run': sub_success + sub_failure, 'succeeded': sub_success,
+              'failed': sub_failure, 'skipped': sub_skipped, 'seconds': time.time() - now}
+
+    if args.junit:
+        results.write_junit(args.junit, records)
+    if args.json:
+        results.write_json(args.json, records, totals, [t for r in spec_results for t in r.types], args.shard)
+
+    # No need for stderr at end of run
+    results.summary(totals, totals['seconds'])
+    if benchmark:
+        print("compute_updates latency (median of %u runs after %u warm-up):" % (args.repeat, args.warmup))
+        benchmark.report()
+        print("-------------------------------------")
+    if args.profile:
+        profiles = profiler.merge(args.profile_dir)
+        shutil.rmtree(args.profile_dir)
+        profiler.write(profiles, args.profile)
+        print("compute_updates profile written to %s" % args.profile)
+        profiler.report(profiles, args.rootdir, args.profile_top)
+        print("-------------------------------------")
+    if args.memprofile:
+        print("Peak RSS per spec:")
+        for r in spec_results:
+            if r.maxrss is not None:
+                print("%8.1f MB  %s" % (r.maxrss / 1048576.0, r.spec_file))
+        memprofile.report(records, args.memprofile_top)
+        print("-------------------------------------")
+    if args.importprofile:
+        importprofile.report([(r.spec_file, test_type, imports)
+                              for r in spec_results for test_type, imports in r.imports], args.importprofile_top)
+        print("-------------------------------------")
+    if args.slowest:
+        print("Slowest compute_updates calls:")
+        for record in results.slowest(records, args.slowest):
+            print(timed_record(record))
+        print("-------------------------------------")
+    perf_problems = 0
+    if args.perf or args.perf_update:
+        regressions = []
+        for r in spec_results:
+            current = baselines.measure(r.records, r.wall_time, r.imports)
+            baseline = baselines.load(r.spec_file)
+            if args.perf and baseline:
+                regressions.extend(baselines.compare(r.spec_file, baseline, current, args.perf_threshold))
+            if args.perf_update and not r.failbreak:
+                if baseline and 'startup' in baseline and 'startup' not in current:
+                    current['startup'] = baseline['startup'] # only measured with --importprofile
+                baselines.save(r.spec_file, current)
+        if args.perf:
+            print("Performance regressions (threshold %g%%): %u" % (args.perf_threshold, len(regressions)))
+            for regression in regressions:
+                print("  %s" % regression)
+            print("-------------------------------------")
+            perf_problems += len(regressions)
+        if args.perf_update:
+            print("Updated the performance baselines of %u spec%s" % (len(spec_results), 's' if len(spec_results) != 1 else ''))
+            print("-------------------------------------")
+    if args.latency_budget:
+        slow = baselines.over_budget(records, args.latency_budget)
+        print("Messages over the %g ms latency budget: %u" % (args.latency_budget, len(slow)))
+        for record in results.slowest(slow, len(slow)):
+            print(timed_record(record))
+        print("-------------------------------------")
+        perf_problems += len(slow)
+    return bool(tests_failure or (perf_problems and args.perf_fail))
+
 
 if __name__ == '__main__':
-    PYTHON3 = sys.executable
     parser = argparse.ArgumentParser(description='Command line options.')
     parser.add_argument('--rootdir', dest='rootdir', type=str, required=True,
                         help="Root directory of Apache Pony Mail")
@@ -30,81 +391,101 @@ if __name__ == '__main__':
                         help="Stop running more tests if an error is encountered")
     parser.add_argument('--skipnodate', dest='skipnodate', action='store_true',
                         help="Skip generator tests with no Date: header")
+    parser.add_argument('--singlepass', dest='singlepass', action='store_true',
+                        help="Parse each message once and run all generator tests on it")
+    parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=1,
+                        help="Number of spec files to run concurrently (default 1)")
+    parser.add_argument('--inprocess', dest='inprocess', action='store_true',
+                        help="Run tests inside long-lived worker processes which import the archiver only once")
+    parser.add_argument('--progress', dest='progress', action='store_true',
+                        help="Show a live count of the tests run so far on stderr")
+    parser.add_argument('--junit', dest='junit', type=str, action='store',
+                        help="Write a JUnit XML report of every test to this file")
+    parser.add_argument('--json', dest='json', type=str, action='store',
+                        help="Write a JSON report of every test to this file")
+    parser.add_argument('--slowest', dest='slowest', type=int, default=0,
+                        help="List the N messages with the slowest compute_updates calls")
+    update_cache.add_arguments(parser)
+    bench.add_arguments(parser)
+    profiler.add_arguments(parser)
+    memprofile.add_arguments(parser)
+    importprofile.add_arguments(parser)
+    shards.add_arguments(parser)
+    watch.add_arguments(parser)
+    parser.add_argument('--shard', dest='shard', type=shard_plan.parse, action='store',
+                        help="Only run shard I of N (given as I/N) of the suite, split by spec and message so that "
+                             "each shard has about the same amount of corpus to process")
+    parser.add_argument('--changed-since', dest='changed_since', type=str, action='store',
+                        help="Only run the test types and generators which may be affected by changes to the "
+                             "Pony Mail sources since this git revision of --rootdir")
+    parser.add_argument('--perf', dest='perf', action='store_true',
+                        help="Compare the timings of each spec with its stored baseline (<spec>%s) and warn "
+                             "about regressions" % baselines.BASELINE_SUFFIX)
+    parser.add_argument('--perf-threshold', dest='perf_threshold', type=float, default=25.0,
+                        help="Percentage by which throughput may drop or wall time increase before it is "
+                             "reported as a regression (default 25)")
+    parser.add_argument('--perf-fail', dest='perf_fail', action='store_true',
+                        help="Fail the run on performance regressions or messages over the latency budget, "
+                             "instead of only warning")
+    parser.add_argument('--perf-update', dest='perf_update', action='store_true',
+                        help="Replace the stored baseline of each spec run with the current timings")
+    parser.add_argument('--latency-budget', dest='latency_budget', type=float, action='store',
+                        help="Report every message whose compute_updates call takes longer than this many "
+                             "milliseconds")
     args = parser.parse_args()
+    if args.workers > 1 and (args.bench or args.profile or args.memprofile or args.importprofile):
+        parser.error('--workers cannot be combined with --bench, --profile, --memprofile or --importprofile')
+    if args.importprofile and (args.inprocess or args.watch):
+        parser.error('--importprofile cannot be combined with --inprocess or --watch, which import the archiver once')
+    if args.watch:
+        if args.jobs > 1:
+            parser.error('--watch cannot be combined with --jobs')
+        args.inprocess = True # keeps the archiver loaded between runs
+
+    if args.inprocess:
+        import inprocess
+        if args.jobs <= 1:
+            inprocess.init_worker(args.rootdir)
 
     yamldir = args.yamldir or "yaml"
 
     if args.load:
         spec_files = args.load
     else:
-        spec_files = [os.path.join(yamldir, x) for x in os.listdir(yamldir) if x.endswith('.yaml')]
-
-    tests_success = 0
-    tests_failure = 0
-    tests_total = 0
-    sub_success = 0
-    sub_failure = 0
-    sub_skipped = 0
-    now = time.time()
+        spec_files = [os.path.join(yamldir, x) for x in sorted(os.listdir(yamldir)) if x.endswith('.yaml')]
 
-    failbreak = False
-    for spec_file in spec_files:
-        with open(spec_file, 'r') as f:
-            yml = yaml.safe_load(f)
-            env = os.environ # always pass parent environ
-            for test_type in yml:
-                if args.ttype and test_type not in args.ttype:
-                    print("Skipping test type %s due to --ttype flag" % test_type)
-                    continue
-                if test_type == 'args':
-                     # Environment variable override, e.g. MOCK_GMTIME
-                    env_ = yml[test_type].get("env", None)
-                    if env_:
-                        for key, val in env_.items():
-                            env[key] = val
-                    continue
-                tests_total += 1
-                # Use stderr so appears in correct sequence in logs; flush seems to be necessary for GitHub actions
-                print("Running '%s' tests from %s..." % (test_type, spec_file), file=sys.stderr, flush=True)
-                try:
-                    cliargs = [PYTHON3, 'tests/test-%s.py' % test_type, '--rootdir', args.rootdir, '--load', spec_file,]
-                    if args.nomboxo:
-                        cliargs.append('--nomboxo')
-                    if args.gtype and test_type == 'generators':
-                        cliargs.append('--generators')
-                        cliargs.extend(args.gtype)
-                    if args.dropin:
-                        cliargs.extend(['--dropin', args.dropin])
-                    if args.skipnodate and test_type == 'generators':
-                        cliargs.append('--skipnodate')
-                    rv = subprocess.check_output(cliargs, env=env)
-                    tests_success += 1
-                except subprocess.CalledProcessError as e:
-                    rv = e.output
-                    print("FAIL: %s test from %s failed with code %d" % (test_type, spec_file, e.returncode), file=sys.stderr, flush=True)
-                    tests_failure += 1
-                    if args.failonfail:
-                        failbreak = True
-                        break
-                finally:
-                    # Fetch successes and failures from this spec run, add to total
-                    m = re.search(r"^\[DONE\] (\d+) tests run, (\d+) failed\.( Skipped (\d+)\.)?", rv.decode('ascii'), re.MULTILINE)
-                    if m:
-                        sub_success += int(m.group(1)) - int(m.group(2))
-                        sub_failure += int(m.group(2))
-                        if m.group(4) is not None:
-                            sub_skipped += int(m.group(4))
-        if failbreak:
-            break
+    # Watch everything, as --changed-since and --shard narrow down the first run only
+    watch_args, watch_specs = argparse.Namespace(**vars(args)), spec_files
+    watch_args.shard = None
 
-    # No need for stderr at end of run
-    print("-------------------------------------")
-    print("Done with %u specification%s in %.2f seconds" % (tests_total, 's' if tests_total != 1 else '', time.time() - now))
-    print("Specs processed: %4u" % tests_total)
-    print("Total tests run: %4u" % (sub_success+sub_failure))
-    print("Tests succeeded: %4u" % sub_success)
-    print("Tests failed:    %4u" % sub_failure)
-    print("Tests skipped:   %4u" % sub_skipped)
-    print("-------------------------------------")
-    if tests_failure:
+    if args.changed_since:
+        import changes
+        try:
+            ttypes, gtypes = changes.select(args.rootdir, args.changed_since)
+        except changes.ChangesError as e:
+            print(e, file=sys.stderr)
+            sys.exit(-1)
+        print("Changes since %s affect test types: %s, generators: %s" %
+              (args.changed_since, 'all' if ttypes is None else ', '.join(ttypes) or 'none',
+               'all' if gtypes is None else ', '.join(gtypes) or 'none'), file=sys.stderr, flush=True)
+        if ttypes is not None:
+            args.ttype = [t for t in ttypes if not args.ttype or t in args.ttype]
+        if gtypes is not None:
+            args.gtype = [g for g in gtypes if not args.gtype or g in args.gtype]
+        spec_files = [spec_file for spec_file in spec_files if spec_selected(spec_file, args)]
+
+    if args.shard:
+        args.shard_ranges = shard_plan.plan(spec_files, args.shard, args.ttype)
+        spec_files = [spec_file for spec_file in spec_files
+                      if any(spec == spec_file for spec, _ in args.shard_ranges)]
+        print("Shard %u/%u: %u spec%s" % (args.shard[0], args.shard[1], len(spec_files),
+                                          's' if len(spec_files) != 1 else ''), file=sys.stderr, flush=True)
+
+    failed = run_suite(spec_files, args)
+    if args.watch:
+        def rerun(args, spec_files, progress):
+            return run_suite([spec_file for spec_file in spec_files if spec_selected(spec_file, args)], args, progress)
+        last = watch.loop(watch_args, watch_specs, rerun, Progress() if args.progress else None)
+        failed = failed if last is None else last
+    if failed:
         sys.exit(-1)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Per-spec performance baselines, stored next to each spec as <spec>.perf
+
+A baseline records, for each test type and generator of the spec, the number
+of timed messages and the compute_updates throughput (messages/second), plus
+the wall time of the whole spec run including interpreter startup and the
+archiver imports. runall.py --perf compares a run against these and reports
+any throughput drop or wall time increase beyond a threshold (and of at
+least MIN_SECONDS in total); runall.py --perf-update writes new baselines
+from the current run.
+
+With --importprofile, the baseline also records the import and startup cost
+(see importprofile.py) of each test type and Pony Mail version: the time and
+RSS growth of the three phases together, and the time of its own of each
+module taking at least MIN_MODULE_SECONDS. An increase beyond the threshold
+(and of at least MIN_STARTUP_SECONDS or MIN_STARTUP_BYTES) is reported along
+with the modules which account for most of it. Runs without --importprofile
+keep the startup costs of the existing baseline.
+
+Timings depend on the machine and the runall.py options (e.g. --jobs), so
+baselines should be made and checked in the same environment.
+"""
+
+import json
+
+import importprofile
+
+BASELINE_SUFFIX = '.perf'
+MIN_SECONDS = 0.1 # smaller slowdowns are within the noise and never reported
+MIN_STARTUP_SECONDS = 0.02
+MIN_STARTUP_BYTES = 1024 * 1024
+MIN_MODULE_SECONDS = 0.001 # modules which take less are not recorded
+
+
+def startup(imports):
+    """Summarises the import and startup costs of the test scripts, by test type and version"""
+    groups = {}
+    for test_type, costs in imports:
+        group = "%s:%s" % (test_type, costs['version'] or '?')
+        phases = costs['phases']
+        modules = {}
+        for module in costs['modules']:
+            if module['time'] >= MIN_MODULE_SECONDS:
+                modules[module['module']] = round(module['time'], 4)
+        groups[group] = {
+            'seconds': round(sum(phases.get(name, {}).get('time', 0.0) for name in importprofile.PHASES), 4),
+            'memory': sum(phases.get(name, {}).get('memory', 0) for name in importprofile.PHASES),
+            'modules': modules,
+        }
+    return groups
+
+
+def measure(records, wall_time, imports=None):
+    """Summarises the test records of one spec run, and the import costs of its test scripts if profiled"""
+    groups = {}
+    for record in records:
+        if record.get('time') is None:
+            continue # skipped or cached
+        group = "%s:%s" % (record['type'], record['generator']) if record['generator'] else record['type']
+        count, total = groups.get(group, (0, 0.0))
+        groups[group] = (count + 1, total + record['time'])
+    current = {
+        'wall_time': round(wall_time, 3),
+        'throughput': {group: {'messages': count, 'msgs_per_sec': round(count / total, 1) if total else None}
+                       for group, (count, total) in sorted(groups.items())},
+    }
+    if imports:
+        current['startup'] = startup(imports)
+    return current
+
+
+def load(spec_file):
+    try:
+        with open(spec_file + BASELINE_SUFFIX, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(spec_file, current):
+    with open(spec_file + BASELINE_SUFFIX, 'w') as f:
+        json.dump(current, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+def compare(spec_file, baseline, current, threshold):
+    """Returns a description of each regression by more than threshold percent"""
+    regressions = []
+    limit = threshold / 100.0
+    before, after = baseline.get('wall_time'), current['wall_time']
+    if before and after > before * (1 + limit) and after - before >= MIN_SECONDS:
+        regressions.append("%s: wall time %.2fs, baseline %.2fs (+%.0f%%)" %
+                           (spec_file, after, before, (after / before - 1) * 100))
+    for group, now in current['throughput'].items():
+        then = baseline.get('throughput', {}).get(group)
+        if not then or not then.get('msgs_per_sec') or not now['msgs_per_sec']:
+            continue
+        extra = now['messages'] / now['msgs_per_sec'] - now['messages'] / then['msgs_per_sec']
+        if now['msgs_per_sec'] < then['msgs_per_sec'] * (1 - limit) and extra >= MIN_SECONDS:
+            regressions.append("%s: %s throughput %.1f msgs/s, baseline %.1f msgs/s (-%.0f%%)" %
+                               (spec_file, group, now['msgs_per_sec'], then['msgs_per_sec'],
+                                (1 - now['msgs_per_sec'] / then['msgs_per_sec']) * 100))
+    for group, now in current.get('startup', {}).items():
+        then = baseline.get('startup', {}).get(group)
+        if not then:
+            continue
+        if then['seconds'] and now['seconds'] > then['seconds'] * (1 + limit) \
+                and now['seconds'] - then['seconds'] >= MIN_STARTUP_SECONDS:
+            regressions.append("%s: %s startup %.3fs, baseline %.3fs (+%.0f%%)%s" %
+                               (spec_file, group, now['seconds'], then['seconds'],
+                                (now['seconds'] / then['seconds'] - 1) * 100, _slower_modules(then, now)))
+        if then['memory'] and now['memory'] > then['memory'] * (1 + limit) \
+                and now['memory'] - then['memory'] >= MIN_STARTUP_BYTES:
+            regressions.append("%s: %s startup RSS %.1f MB, baseline %.1f MB (+%.0f%%)" %
+                               (spec_file, group, now['memory'] / 1048576.0, then['memory'] / 1048576.0,
+                                (now['memory'] / then['memory'] - 1) * 100))
+    return regressions
+
+
+def _slower_modules(then, now, count=3):
+    """The modules whose own import time grew the most, e.g. ', mostly in html2text +0.120s'"""
+    grown = [(seconds - then['modules'].get(name, 0.0), name) for name, seconds in now['modules'].items()]
+    grown = sorted((item for item in grown if item[0] >= MIN_MODULE_SECONDS), reverse=True)[:count]
+    if not grown:
+        return ''
+    return ', mostly in %s' % ', '.join("%s %+.3fs" % (name, seconds) for seconds, name in grown)
+
+
+def over_budget(records, budget_ms):
+    """Records of the messages whose compute_updates took longer than budget_ms"""
+    return [r for r in records if r.get('time') is not None and r['time'] * 1000 > budget_ms]
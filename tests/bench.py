@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Archiver throughput benchmark, used by the --bench option.
+
+Each compute_updates call is run --warmup times untimed and then --repeat
+times timed; the median of the timed runs is the latency of that message.
+Latencies are grouped by generator (or test type), corpus file and detected
+Pony Mail version, and reported as messages/second and p50/p95/p99/max.
+
+The tests are still checked as usual, using the result of the last run.
+"""
+
+import collections
+import math
+import statistics
+import sys
+import time
+
+DEFAULT_WARMUP = 1
+DEFAULT_REPEAT = 3
+
+
+def add_arguments(parser):
+    """Adds the benchmark options to a test script or runall.py argument parser"""
+    parser.add_argument('--bench', dest='bench', action='store_true',
+                        help='Benchmark compute_updates and report latency percentiles (disables the result cache)')
+    parser.add_argument('--warmup', dest='warmup', type=int, default=DEFAULT_WARMUP,
+                        help='Untimed compute_updates calls per message before timing in --bench mode (default %u)'
+                             % DEFAULT_WARMUP)
+    parser.add_argument('--repeat', dest='repeat', type=int, default=DEFAULT_REPEAT,
+                        help='Timed compute_updates calls per message in --bench mode (default %u)' % DEFAULT_REPEAT)
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an ascending list"""
+    rank = max(1, math.ceil(pct * len(ordered) / 100.0))
+    return ordered[rank - 1]
+
+
+class Bench(object):
+    def __init__(self, warmup=DEFAULT_WARMUP, repeat=DEFAULT_REPEAT):
+        self.warmup = warmup
+        self.repeat = max(1, repeat)
+        self.latencies = collections.defaultdict(list)
+
+    def time(self, compute):
+        """Runs compute() as configured, returning its last result and the median time"""
+        for _ in range(self.warmup):
+            compute()
+        times = []
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            result = compute()
+            times.append(time.perf_counter() - started)
+        return result, statistics.median(times)
+
+    def add(self, generator, mboxfile, version, latency):
+        self.latencies[(generator, mboxfile, version)].append(latency)
+
+    def report(self, out=sys.stdout):
+        print("%-10s %-50s %-6s %6s %9s %9s %9s %9s %9s" %
+              ('generator', 'corpus', 'vers', 'msgs', 'msgs/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'), file=out)
+        for (generator, mboxfile, version), latencies in sorted(self.latencies.items(),
+                                                                key=lambda item: tuple(str(k) for k in item[0])):
+            ordered = sorted(latencies)
+            total = sum(ordered)
+            print("%-10s %-50s %-6s %6u %9.1f %9.3f %9.3f %9.3f %9.3f" %
+                  (generator, mboxfile, version, len(ordered), len(ordered) / total if total else 0,
+                   percentile(ordered, 50) * 1000, percentile(ordered, 95) * 1000,
+                   percentile(ordered, 99) * 1000, ordered[-1] * 1000), file=out)
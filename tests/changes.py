@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Works out which tests can be affected by changes to the Pony Mail sources.
+
+Only modules imported (directly or indirectly) by tools/archiver.py are
+considered. If the only such modules changed are generators.py, then only the
+generator tests need to be run, and only for the generators whose functions
+changed (or call a function that changed). Any other change can affect
+everything.
+
+The old sources are taken from git, comparing a revision of the Pony Mail
+checkout with its working tree, e.g. --changed-since HEAD for uncommitted work.
+
+To use:
+
+import changes
+ttypes, gtypes = changes.select(rootdir, 'HEAD')
+# None means all, an empty list means nothing is affected
+ttypes, gtypes = changes.affected(tools_dir, changed_paths, old_source) # other sources of old versions
+"""
+
+import ast
+import os
+import subprocess
+
+DEFAULT_GENERATORS = ['full', 'medium', 'cluster', 'legacy', 'dkim']
+
+
+class ChangesError(Exception):
+    pass
+
+
+def _git(rootdir, *args):
+    try:
+        return subprocess.check_output(['git', '-C', rootdir] + list(args), stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as e:
+        message = getattr(e, 'stderr', None) or str(e)
+        if isinstance(message, bytes):
+            message = message.decode('utf-8', 'replace')
+        raise ChangesError("git %s failed: %s" % (' '.join(args), message.strip()))
+
+
+def _resolve(tools_dir, name):
+    """Returns the path of a module under tools_dir, or None if it is not there"""
+    base = os.path.join(tools_dir, *name.split('.'))
+    for path in (base + '.py', os.path.join(base, '__init__.py')):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def archiver_modules(tools_dir):
+    """Paths of archiver.py and the modules under tools_dir that it imports"""
+    todo = [os.path.join(tools_dir, 'archiver.py')]
+    seen = set()
+    while todo:
+        path = todo.pop()
+        if path in seen or not os.path.isfile(path):
+            continue
+        seen.add(path)
+        with open(path, 'rb') as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            names = []
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                # from plugins import generators may import a module or a name
+                names = [node.module] + ['%s.%s' % (node.module, alias.name) for alias in node.names]
+            for name in names:
+                module = _resolve(tools_dir, name)
+                if module:
+                    todo.append(module)
+    return seen
+
+
+def _analyse(source):
+    """Returns (top level functions, dump of other top level code, generator name to function map)"""
+    tree = ast.parse(source)
+    functions = {}
+    other = []
+    mapping = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            functions[node.name] = node
+        else:
+            other.append(ast.dump(node))
+            if isinstance(node, ast.Assign) and isinstance(node.value, ast.Dict):
+                for k, v in zip(node.value.keys, node.value.values):
+                    if isinstance(k, ast.Constant) and isinstance(k.value, str) and isinstance(v, ast.Name):
+                        mapping[k.value] = v.id
+    if not mapping:
+        mapping = {name: name for name in DEFAULT_GENERATORS if name in functions}
+    return functions, other, mapping
+
+
+def changed_generators(old_source, new_source):
+    """Names of the generators whose code differs, or None if all may be affected"""
+    if old_source is None:
+        return None
+    old_functions, old_other, _ = _analyse(old_source)
+    new_functions, new_other, mapping = _analyse(new_source)
+    if old_other != new_other:
+        return None # imports, constants etc.
+    changed = set(name for name in set(old_functions) | set(new_functions)
+                  if name not in old_functions or name not in new_functions
+                  or ast.dump(old_functions[name]) != ast.dump(new_functions[name]))
+    calls = {name: set(n.id for n in ast.walk(node) if isinstance(n, ast.Name) and n.id in new_functions)
+             for name, node in new_functions.items()}
+
+    def affected(name, seen):
+        if name in changed:
+            return True
+        seen.add(name)
+        return any(affected(callee, seen) for callee in calls.get(name, ()) if callee not in seen)
+
+    return sorted(gen for gen, function in mapping.items() if affected(function, set()))
+
+
+def affected(tools_dir, changed, old_source):
+    """
+    Returns (test types, generators) that may be affected by changes to the files
+    in changed, given old_source(path) which returns the previous contents of a
+    file (None if it is new). None means all; [] means none.
+    """
+    relevant = set(changed) & archiver_modules(tools_dir)
+    if not relevant:
+        return [], []
+    if any(os.path.basename(path) != 'generators.py' for path in relevant):
+        return None, None
+    generators = set()
+    for path in relevant:
+        with open(path, 'rb') as f:
+            new_source = f.read()
+        names = changed_generators(old_source(path), new_source)
+        if names is None:
+            return ['generators'], None
+        generators.update(names)
+    return ['generators'], sorted(generators)
+
+
+def select(rootdir, rev):
+    """
+    Returns (test types, generators) that may be affected by changes between
+    rev and the working tree of rootdir. None means all; [] means none.
+    """
+    tools_dir = os.path.realpath(os.path.join(rootdir, 'tools'))
+    toplevel = _git(rootdir, 'rev-parse', '--show-toplevel').decode('utf-8').strip()
+    output = _git(rootdir, 'diff', '--name-only', rev, '--', tools_dir).decode('utf-8')
+    changed = set(os.path.realpath(os.path.join(toplevel, line)) for line in output.splitlines() if line)
+
+    def old_source(path):
+        relpath = os.path.relpath(path, toplevel)
+        try:
+            return _git(rootdir, 'show', '%s:%s' % (rev, relpath.replace(os.sep, '/')))
+        except ChangesError:
+            return None # new file
+
+    return affected(tools_dir, changed, old_source)
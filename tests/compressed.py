@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Seekable reading of compressed mbox files: .gz, .xz and, with Python 3.14 or
+the zstandard package, .zst.
+
+A compressed file is a sequence of frames which can each be decompressed on
+their own: gzip members, xz streams or zstd frames. The block index lists
+where each frame starts in the compressed file and in the decompressed
+data, so a message is read by decompressing just the frames it spans. It is
+built in a single pass over the file and saved in a sidecar file
+(<file>.blocks), which is rebuilt when the file's size or mtime changes.
+
+Files written by the usual tools have a single frame. That works, but a
+read has to decompress from the start of the file, except that reading on
+from where the previous read stopped carries on decompressing from there.
+Use tools/compress-mbox.py (or e.g. bgzip) to write a frame every MB or so.
+
+To use:
+
+import compressed
+f = compressed.open(path) # for a plain mbox, the same as open(path, 'rb')
+mbox = compressed.open_mbox(path, factory) # mailbox.mbox, read only
+reader = compressed.BlockReader(path) # as MboxoMmapReader
+"""
+
+import bisect
+import builtins
+import collections
+import gzip
+import io
+import json
+import lzma
+import mailbox
+import os
+import zlib
+
+from mboxo_patch import FROM_MANGLED, FROM_UNMANGLED
+
+BLOCKS_VERSION = 1
+BLOCKS_SUFFIX = '.blocks'
+READ_SIZE = 1024 * 1024 # compressed bytes read at a time
+MAX_CACHED_BLOCK = 16 * 1024 * 1024 # larger frames are decompressed as a stream instead of being cached
+CACHED_BLOCKS = 4
+
+Codec = collections.namedtuple('Codec', ['decompressor', 'compress'])
+
+
+def _zstd():
+    try:
+        from compression import zstd # pylint: disable=import-outside-toplevel
+        return Codec(zstd.ZstdDecompressor, zstd.compress)
+    except ImportError:
+        pass
+    try:
+        import zstandard # pylint: disable=import-outside-toplevel
+        return Codec(lambda: zstandard.ZstdDecompressor().decompressobj(),
+                     lambda data: zstandard.ZstdCompressor().compress(data))
+    except ImportError:
+        return None
+
+
+CODECS = {
+    '.gz': Codec(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), lambda data: gzip.compress(data, mtime=0)),
+    '.xz': Codec(lzma.LZMADecompressor, lzma.compress),
+    '.zst': _zstd(),
+}
+
+_blocks = {} # already loaded in this process, by (path, size, mtime)
+
+
+class CompressionError(Exception):
+    pass
+
+
+def is_compressed(path):
+    return os.path.splitext(path)[1] in CODECS
+
+
+def codec(path):
+    suffix = os.path.splitext(path)[1]
+    if CODECS.get(suffix) is None:
+        raise CompressionError("%s: %s files need Python 3.14 or the zstandard package" % (path, suffix))
+    return CODECS[suffix]
+
+
+def build(path):
+    """
+    Decompresses a file, returning [[compressed offset, decompressed offset], ...] for the start
+    of each frame, followed by the compressed and decompressed sizes
+    """
+    new_decompressor = codec(path).decompressor
+    blocks = []
+    decompressor = None
+    pos = 0 # compressed offset of data
+    out = 0
+    data = b''
+    with builtins.open(path, 'rb') as f:
+        while True:
+            if not data:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+            if decompressor is None:
+                stripped = data.lstrip(b'\0') # padding between frames
+                pos += len(data) - len(stripped)
+                data = stripped
+                if not data:
+                    continue
+                decompressor = new_decompressor()
+                blocks.append([pos, out])
+            out += len(decompressor.decompress(data))
+            if decompressor.eof:
+                unused = decompressor.unused_data
+                pos += len(data) - len(unused)
+                data = unused
+                decompressor = None
+            else:
+                pos += len(data)
+                data = b''
+    if decompressor is not None:
+        raise CompressionError("%s is truncated" % path)
+    blocks.append([pos, out])
+    return blocks
+
+
+def load(path):
+    """Returns the block index for a compressed file, from the sidecar if it is still valid"""
+    st = os.stat(path)
+    cache_key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    if cache_key in _blocks:
+        return _blocks[cache_key]
+    sidecar = path + BLOCKS_SUFFIX
+    index = None
+    try:
+        with builtins.open(sidecar, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if index is None or index.get('version') != BLOCKS_VERSION or index.get('size') != st.st_size \
+            or index.get('mtime') != st.st_mtime_ns:
+        index = {'version': BLOCKS_VERSION, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'blocks': build(path)}
+        try:
+            with builtins.open(sidecar + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.replace(sidecar + '.tmp', sidecar)
+        except OSError:
+            pass # index is still usable in memory
+    _blocks[cache_key] = index['blocks']
+    return index['blocks']
+
+
+class _Stream(object):
+    """Decompression of a frame in progress, for frames too large to cache"""
+    def __init__(self, block, start, decompressor):
+        self.block = block
+        self.decompressor = decompressor
+        self.in_pos = start # next compressed offset to read
+        self.out_pos = 0 # decompressed offset within the frame of buffer[0]
+        self.buffer = b''
+
+
+class BlockFile(io.RawIOBase):
+    """Read-only, seekable raw file of the decompressed contents of a compressed file"""
+    def __init__(self, path):
+        super().__init__()
+        self.codec = codec(path)
+        self.blocks = load(path)
+        self.starts = [out for _, out in self.blocks]
+        self.size = self.starts[-1]
+        self._file = builtins.open(path, 'rb')
+        self._pos = 0
+        self._cache = collections.OrderedDict()
+        self._stream = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._pos = offset
+        return offset
+
+    def readinto(self, b):
+        data = self.pread(self._pos, min(self._pos + len(b), self.size))
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def pread(self, start, stop):
+        """Returns the decompressed bytes from start to stop"""
+        parts = []
+        while start < stop:
+            block = bisect.bisect_right(self.starts, start) - 1
+            end = min(stop, self.starts[block + 1])
+            parts.append(self._read_block(block, start - self.starts[block], end - self.starts[block]))
+            start = end
+        return b''.join(parts)
+
+    def _compressed(self, block, pos, size):
+        self._file.seek(pos)
+        return self._file.read(min(size, self.blocks[block + 1][0] - pos))
+
+    def _read_block(self, block, start, stop):
+        if self.starts[block + 1] - self.starts[block] > MAX_CACHED_BLOCK:
+            return self._read_stream(block, start, stop)
+        if block in self._cache:
+            self._cache.move_to_end(block)
+        else:
+            decompressor = self.codec.decompressor()
+            size = self.blocks[block + 1][0] - self.blocks[block][0]
+            self._cache[block] = decompressor.decompress(self._compressed(block, self.blocks[block][0], size))
+            if len(self._cache) > CACHED_BLOCKS:
+                self._cache.popitem(last=False)
+        return self._cache[block][start:stop]
+
+    def _read_stream(self, block, start, stop):
+        stream = self._stream
+        if stream is None or stream.block != block or stream.out_pos > start:
+            stream = self._stream = _Stream(block, self.blocks[block][0], self.codec.decompressor())
+        while True:
+            if stream.out_pos < start: # not needed again unless reading backwards
+                drop = min(start - stream.out_pos, len(stream.buffer))
+                stream.buffer = stream.buffer[drop:]
+                stream.out_pos += drop
+            if stream.out_pos + len(stream.buffer) >= stop or stream.decompressor.eof:
+                break
+            data = self._compressed(block, stream.in_pos, READ_SIZE)
+            if not data:
+                break
+            stream.in_pos += len(data)
+            stream.buffer += stream.decompressor.decompress(data)
+        return stream.buffer[start - stream.out_pos:stop - stream.out_pos]
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            self._cache.clear()
+            self._stream = None
+        super().close()
+
+
+def open(path): # pylint: disable=redefined-builtin
+    """Opens an mbox file for binary reading, decompressing it if need be"""
+    if is_compressed(path):
+        return io.BufferedReader(BlockFile(path), READ_SIZE)
+    return builtins.open(path, 'rb')
+
+
+def use_decompressed(mbox):
+    """Makes a mailbox.mbox opened on a compressed file read the decompressed contents instead"""
+    if is_compressed(mbox._path): # pylint: disable=protected-access
+        mbox._file.close() # pylint: disable=protected-access
+        mbox._file = open(mbox._path) # pylint: disable=protected-access
+    return mbox
+
+
+def open_mbox(path, factory=None):
+    """mailbox.mbox for a plain or compressed mbox file, which must not be changed"""
+    return use_decompressed(mailbox.mbox(path, factory, create=False))
+
+
+class BlockReader(object):
+    """Reads byte ranges of a compressed mbox file, optionally with mboxo unmangling, as MboxoMmapReader does"""
+    def __init__(self, path):
+        self._file = BlockFile(path)
+
+    def read(self, start, stop, unmangle=True):
+        """Returns the bytes from start to stop, replacing b'\\n>From ' with b'\\nFrom ' if unmangle is set"""
+        data = self._file.pread(start, stop)
+        return data.replace(FROM_MANGLED, FROM_UNMANGLED) if unmangle else data
+
+    def next_line(self, pos):
+        """Returns the offset of the line following the one at pos"""
+        while pos < self._file.size:
+            chunk = self._file.pread(pos, min(pos + 8192, self._file.size))
+            eol = chunk.find(b'\n')
+            if eol != -1:
+                return pos + eol + 1
+            pos += len(chunk)
+        return self._file.size
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Runs compute_updates for the test scripts, applying the options which
+change how the call is made: the result cache (--cache), the benchmark
+(--bench), the profiler (--profile), the memory profiler (--memprofile) and
+the import profiler (--importprofile), which the test script creates before it
+imports the archiver. Each call returns the result and the time taken, which
+is None if the result came from the cache. With --memprofile, compute.memory
+is set by each call to the peak allocation and raw size of the message, for
+the test record.
+
+To use:
+
+compute = Compute(args, 'generators', importprofile.from_args(args))
+json, elapsed = compute(archie, gen_type, mboxfile, (lid,), fake_args, lid, False, message, message_raw)
+...
+compute.close()
+"""
+
+import functools
+import sys
+import time
+
+import bench
+import importprofile
+import memprofile
+import profiler
+import update_cache
+
+
+def add_arguments(parser):
+    update_cache.add_arguments(parser)
+    bench.add_arguments(parser)
+    profiler.add_arguments(parser)
+    memprofile.add_arguments(parser)
+    importprofile.add_arguments(parser)
+
+
+class Compute(object):
+    def __init__(self, args, test_type, importprofiler=None):
+        self.args = args
+        self.test_type = test_type
+        self.benchmark = bench.Bench(args.warmup, args.repeat) if args.bench else None
+        self.profiler = profiler.Profiler() if args.profile or args.profile_dir else None
+        self.memprofiler = memprofile.MemProfiler() if args.memprofile else None
+        self.importprofiler = importprofiler
+        self.memory = None
+        self.memory_records = []
+        # Benchmarks and profiles must run the archiver, so cannot use the cache
+        self.cache = None if self.benchmark or self.profiler or self.memprofiler or self.importprofiler \
+            else update_cache.from_args(args, args.rootdir)
+
+    def __call__(self, archie, label, mboxfile, cache_extra, fake_args, lid, private, message, message_raw):
+        """Returns (result, elapsed); label and mboxfile group the benchmark, cache_extra adds to the cache key"""
+        def run():
+            return archie.compute_updates(fake_args, lid, private, message, message_raw)
+        if self.profiler:
+            run = functools.partial(self.profiler.call, self.test_type, label, run)
+        if self.memprofiler:
+            self.memprofiler.peak = None
+            run = functools.partial(self.memprofiler.call, run)
+        if self.importprofiler:
+            self.importprofiler.version = archie.version
+            run = functools.partial(self.importprofiler.first, importprofile.FIRST_CALL, label, run)
+        if self.benchmark:
+            json, elapsed = self.benchmark.time(run)
+            self.benchmark.add(label, mboxfile, archie.version, elapsed)
+        else:
+            if self.cache:
+                cache_key = self.cache.key(archie, message_raw, *cache_extra)
+                json = self.cache.get(cache_key)
+                if json is not update_cache.MISS:
+                    return json, None # not timed when the result came from the cache
+            started = time.perf_counter()
+            json = run()
+            elapsed = time.perf_counter() - started
+            if self.cache:
+                self.cache.put(cache_key, json)
+        if self.memprofiler:
+            self.memory = {'peak': self.memprofiler.peak, 'raw': len(message_raw)}
+            if not self.args.jsonl:
+                self.memory_records.append({'type': self.test_type, 'mbox': mboxfile, 'memory': self.memory,
+                                            'generator': None if label == self.test_type else label,
+                                            'message-id': (message.get('message-id') or '').strip()})
+        return json, elapsed
+
+    def close(self):
+        if self.cache:
+            self.cache.close()
+            sys.stderr.write("Result cache: %u hits, %u misses\n" % (self.cache.hits, self.cache.misses))
+        if self.benchmark and not self.args.jsonl:
+            self.benchmark.report() # runall.py reports the combined results in --jsonl mode
+        if self.profiler:
+            if self.args.profile_dir:
+                self.profiler.dump(self.args.profile_dir) # merged by runall.py
+            else:
+                stats = self.profiler.stats()
+                profiler.write(stats, self.args.profile)
+                profiler.report(stats, self.args.rootdir, self.args.profile_top, sys.stderr if self.args.jsonl else sys.stdout)
+        if self.memprofiler:
+            self.memprofiler.close()
+            if not self.args.jsonl: # runall.py reports on the test records instead
+                memprofile.report(self.memory_records, self.args.memprofile_top)
+                print("Peak RSS: %.1f MB" % (memprofile.maxrss() / 1048576.0))
+        if self.importprofiler:
+            self.importprofiler.close()
+            if not self.args.jsonl: # runall.py reports the costs of all the specs
+                importprofile.report([(self.args.load, self.test_type, self.importprofiler.record())],
+                                     self.args.importprofile_top)
+
+    @property
+    def maxrss(self):
+        """Peak RSS for the final test record, if --memprofile was given"""
+        return memprofile.maxrss() if self.memprofiler else None
+
+    @property
+    def imports(self):
+        """Import and startup costs for the final test record, if --importprofile was given"""
+        return self.importprofiler.record() if self.importprofiler else None
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Deterministic environment for the archiver, as set by the env of a spec.
+
+- MOCK_GMTIME: time.gmtime() without an argument returns the epoch when called
+  from tools/archiver.py or tools/generators.py. Rather than replacing
+  time.gmtime for everyone and inspecting the stack on each call to find the
+  caller, the modules' own 'time' global (or a 'gmtime' imported from it)
+  is replaced with a frozen clock, so calls from elsewhere are unaffected and
+  the mocked calls cost about the same as real ones.
+- MOCK_AAT: the Archived-At date given to the medium generator (see archived_at).
+- PYTHONHASHSEED: cannot change once Python has started, so callers that reuse
+  a process must check hashseed_matches and otherwise start a new one.
+
+apply() must be called after the archiver is imported, and again whenever the
+environment changes; it is a no-op for modules which are already set up. Worker
+processes call it as part of setting up the test script, so they behave the same.
+
+To use:
+
+import archiver
+deterministic.apply()
+...
+deterministic.restore() # e.g. before running another spec in the same process
+"""
+
+import email.utils
+import os
+import sys
+import time
+import types
+
+MOCKED_FILES = ('/tools/archiver.py', 'tools/generators.py') # whose calls to time.gmtime() are mocked
+
+_replaced = {} # module name -> {global name: original value}
+
+
+class FrozenTime(types.ModuleType):
+    """The time module, except that gmtime() without an argument returns a fixed time"""
+    def __init__(self, secs):
+        super().__init__('time', time.__doc__)
+        frozen = time.gmtime(secs) # struct_time is immutable, so can be shared
+        real_gmtime = time.gmtime
+        def gmtime(secs=None):
+            return frozen if secs is None else real_gmtime(secs)
+        self.gmtime = gmtime
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def _mocked_modules():
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, '__file__', None) or ''
+        if filename.endswith(MOCKED_FILES):
+            yield name, module
+
+
+def freeze_clock(secs=0):
+    """Gives the archiver modules which are already imported a clock frozen at secs for time.gmtime()"""
+    restore()
+    frozen = FrozenTime(secs)
+    for name, module in _mocked_modules():
+        replaced = {}
+        for key, value in list(vars(module).items()):
+            if value is time:
+                replaced[key] = value
+                setattr(module, key, frozen)
+            elif value is time.gmtime:
+                replaced[key] = value
+                setattr(module, key, frozen.gmtime)
+        if replaced:
+            _replaced[name] = replaced
+
+
+def restore():
+    """Puts back the real clock"""
+    for name, replaced in _replaced.items():
+        module = sys.modules.get(name)
+        if module is not None:
+            for key, value in replaced.items():
+                setattr(module, key, value)
+    _replaced.clear()
+
+
+def apply(env=None):
+    """Sets up the archiver modules for MOCK_GMTIME in env (default os.environ)"""
+    env = os.environ if env is None else env
+    if env.get('MOCK_GMTIME'):
+        freeze_clock(0) # the value only turns it on
+    else:
+        restore()
+
+
+def archived_at(env):
+    """The Archived-At header for MOCK_AAT in env (e.g. a spec's args.env), or None"""
+    if 'MOCK_AAT' not in env:
+        return None
+    return email.utils.formatdate(int(env['MOCK_AAT']), False)
+
+
+def hashseed_matches(env):
+    """Can a test needing this environment run in the current process?"""
+    return env.get('PYTHONHASHSEED') == os.environ.get('PYTHONHASHSEED')
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Import and startup cost of the archiver, used by the --importprofile option.
+
+Importers are often short-lived processes, so the cost of importing the
+archiver and its optional dependencies (html2text, dkim helpers, ...) is paid
+for every batch of messages, as it is by every test script runall.py starts.
+While the profiler is installed, every module loaded is timed, along with the
+growth of the process RSS while it loads. Each is counted in the phase of the
+test script that loaded it:
+
+import                  the imports of archiver.py (and generators.py)
+construct               the first interfacer.Archiver for each generator
+first compute_updates   the first compute_updates call for each generator
+
+time and memory are the module's own: the modules it imported in turn are
+counted separately (cumtime and cummemory include them). Modules which the test
+harness had already imported (e.g. email, yaml) are not counted. RSS is measured
+in whole pages, so the memory of small modules is only approximate.
+
+With --jsonl, the final record of a test script gets
+"imports": {"version": "foal", "phases": {phase: {"time": s, "memory": bytes}}, "modules": [...]}
+with the modules in the order they were loaded.
+
+To use:
+
+profile = importprofile.from_args(args) # None unless --importprofile
+with importprofile.phase(profile, importprofile.IMPORT):
+    import archiver
+archie = importprofile.first(profile, importprofile.CONSTRUCT, gen_type, lambda: interfacer.Archiver(...))
+...
+profile.close()
+"""
+
+import contextlib
+import resource
+import sys
+import time
+
+import memprofile
+
+DEFAULT_TOP = 10
+
+IMPORT = 'import'
+CONSTRUCT = 'construct'
+FIRST_CALL = 'first compute_updates'
+PHASES = (IMPORT, CONSTRUCT, FIRST_CALL)
+
+PAGE_SIZE = resource.getpagesize()
+
+
+def add_arguments(parser):
+    """Adds the import profiling options to a test script or runall.py argument parser"""
+    parser.add_argument('--importprofile', dest='importprofile', action='store_true',
+                        help='Record the time and memory taken by each module imported by the archiver, its '
+                             'construction and the first compute_updates call, and list the costliest modules')
+    parser.add_argument('--importprofile-top', dest='importprofile_top', type=int, default=DEFAULT_TOP,
+                        help='Number of modules to list with --importprofile (default %u)' % DEFAULT_TOP)
+
+
+def rss():
+    """Resident set size of this process in bytes (the peak where the current size is not available)"""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return memprofile.maxrss()
+
+
+class _Load(object):
+    """A module being loaded, while its nested imports are counted"""
+    def __init__(self, name, phase):
+        self.name = name
+        self.phase = phase
+        self.time = 0.0
+        self.memory = 0
+        self.nested_time = 0.0
+        self.nested_memory = 0
+
+
+class _Loader(object):
+    """Wraps the loader of a module to time it; the module gets the original loader back once loaded"""
+    def __init__(self, loader, profile):
+        self.loader = loader
+        self.profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        # extension modules do all or part of their initialisation here
+        return self.profile.timed(spec.name, self.loader.create_module, spec)
+
+    def exec_module(self, module):
+        try:
+            self.profile.timed(module.__name__, self.loader.exec_module, module)
+        finally:
+            if module.__spec__ is not None and module.__spec__.loader is self:
+                module.__spec__.loader = self.loader
+            if getattr(module, '__loader__', None) is self:
+                module.__loader__ = self.loader
+
+
+class _Finder(object):
+    """Meta path finder which asks the other finders, and wraps the loader of the spec they return"""
+    def __init__(self, profile):
+        self.profile = profile
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            find_spec = getattr(finder, 'find_spec', None)
+            if finder is self or find_spec is None:
+                continue
+            spec = find_spec(fullname, path, target)
+            if spec is not None:
+                if hasattr(spec.loader, 'create_module') and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _Loader(spec.loader, self.profile)
+                return spec
+        return None
+
+
+class ImportProfiler(object):
+    def __init__(self):
+        self.finder = _Finder(self)
+        sys.meta_path.insert(0, self.finder)
+        self.version = None
+        self.current = None # phase
+        self.phases = {} # phase -> [time, memory]
+        self.modules = {} # name -> _Load, in the order they were loaded
+        self.loading = []
+        self.done = set() # (phase, label) of first()
+
+    def timed(self, name, fn, *args):
+        """Returns fn(*args), counting its time and RSS growth towards module name"""
+        load = self.modules.get(name)
+        if load is None:
+            load = self.modules[name] = _Load(name, self.current)
+        self.loading.append(load)
+        memory = rss()
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            grown = rss() - memory
+            self.loading.pop()
+            load.time += elapsed
+            load.memory += grown
+            if self.loading:
+                self.loading[-1].nested_time += elapsed
+                self.loading[-1].nested_memory += grown
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Counts the time and RSS growth of the block, and the modules it loads, towards the phase"""
+        previous, self.current = self.current, name
+        memory = rss()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            totals = self.phases.setdefault(name, [0.0, 0])
+            totals[0] += time.perf_counter() - started
+            totals[1] += rss() - memory
+            self.current = previous
+
+    def first(self, name, label, fn):
+        """Returns fn(), counted in the phase if it is the first call for label (e.g. generator) in it"""
+        if (name, label) in self.done:
+            return fn()
+        self.done.add((name, label))
+        with self.phase(name):
+            return fn()
+
+    def record(self):
+        """The costs for the final test record (see the module docstring)"""
+        return {
+            'version': self.version,
+            'phases': {name: {'time': round(t, 6), 'memory': memory} for name, (t, memory) in self.phases.items()},
+            'modules': [{'module': load.name, 'phase': load.phase,
+                         'time': round(load.time - load.nested_time, 6), 'cumtime': round(load.time, 6),
+                         'memory': load.memory - load.nested_memory, 'cummemory': load.memory}
+                        for load in self.modules.values() if load.phase is not None],
+        }
+
+    def close(self):
+        if self.finder in sys.meta_path:
+            sys.meta_path.remove(self.finder)
+
+
+def from_args(args):
+    """The profiler for the test script's options, installed from now on, or None"""
+    return ImportProfiler() if getattr(args, 'importprofile', False) else None
+
+
+def phase(profile, name):
+    """profile.phase(name), or nothing if not profiling"""
+    return profile.phase(name) if profile else contextlib.nullcontext()
+
+
+def first(profile, name, label, fn):
+    """profile.first(name, label, fn), or just fn() if not profiling"""
+    return profile.first(name, label, fn) if profile else fn()
+
+
+def report(runs, top=DEFAULT_TOP, out=sys.stdout):
+    """
+    Lists the cost of each phase for each (spec, test type, record) in runs, followed
+    by the top modules with the most time of their own, averaged over the runs of each version
+    """
+    print("Import and startup cost (seconds):", file=out)
+    print("%-8s %10s %10s %10s %10s %9s  %s" % ('version', 'import', 'construct', 'first call', 'total', 'RSS MB',
+                                               'spec'), file=out)
+    modules = {} # (version, module) -> [runs, time, memory]
+    for spec, test_type, record in runs:
+        phases = record['phases']
+        times = [phases.get(name, {}).get('time', 0.0) for name in PHASES]
+        memory = sum(phases.get(name, {}).get('memory', 0) for name in PHASES)
+        print("%-8s %10.3f %10.3f %10.3f %10.3f %9.1f  %s %s" % (record['version'] or '?', times[0], times[1],
+                                                               times[2], sum(times), memory / 1048576.0, spec,
+                                                               test_type), file=out)
+        for module in record['modules']:
+            totals = modules.setdefault((record['version'] or '?', module['module'], module['phase']), [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += module['time']
+            totals[2] += module['memory']
+    print("Modules with the most import time of their own (mean per test script):", file=out)
+    print("%-8s %9s %9s  %-22s %s" % ('version', 'ms', 'RSS KB', 'phase', 'module'), file=out)
+    ranked = sorted(modules.items(), key=lambda item: (item[1][1] / item[1][0], item[0]), reverse=True)
+    for (version, name, phase_name), (count, seconds, memory) in ranked[:top]:
+        print("%-8s %9.2f %9.0f  %-22s %s" % (version, seconds / count * 1000, memory / count / 1024.0, phase_name,
+                                               name), file=out)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Runs the test scripts as libraries inside a long-lived process, so that the
+archiver and its optional dependencies are only imported once per process
+rather than once per spec and test type.
+
+Each run gets the same isolation as a subprocess would for the things the
+test scripts change: environment variables (e.g. MOCK_GMTIME), the archiver
+clock frozen for MOCK_GMTIME, the root logger handlers and stdout/stderr.
+PYTHONHASHSEED cannot be changed after startup, so callers must fall back to
+a subprocess if a spec needs a different seed (see deterministic.hashseed_matches).
+
+To use:
+
+import inprocess
+inprocess.init_worker(rootdir)
+returncode, stdout, stderr = inprocess.run_test('generators', ['--rootdir', rootdir, '--load', spec], env)
+"""
+
+import contextlib
+import importlib.util
+import io
+import logging
+import os
+import sys
+import traceback
+
+import deterministic
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+_modules = {}
+
+
+def init_worker(rootdir):
+    """Prepares this process for running tests: sets up the paths and imports the archiver once"""
+    if TESTS_DIR not in sys.path:
+        sys.path.insert(0, TESTS_DIR)
+    tools_dir = os.path.join(rootdir, 'tools')
+    if tools_dir not in sys.path:
+        sys.path.append(tools_dir)
+    import archiver # pylint: disable=unused-import,import-outside-toplevel
+
+
+def load_test_module(test_type):
+    """Imports tests/test-<type>.py as a module (the file names are not valid module names)"""
+    if test_type not in _modules:
+        path = os.path.join(TESTS_DIR, 'test-%s.py' % test_type)
+        spec = importlib.util.spec_from_file_location('test_%s' % test_type, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[test_type] = module
+    return _modules[test_type]
+
+
+class LineStream(io.TextIOBase):
+    """Text stream that passes each complete line to a callback as it is written"""
+    def __init__(self, on_line):
+        super().__init__()
+        self.on_line = on_line
+        self.partial = ''
+
+    def write(self, s):
+        lines = (self.partial + s).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.on_line(line)
+        return len(s)
+
+
+def run_test(test_type, argv, env, capture_stderr=False, on_line=None):
+    """
+    Runs the main() of a test script with the given arguments and environment.
+    Returns (returncode, stdout, stderr) as a subprocess would; stderr is None
+    unless capture_stderr is set, in which case it is passed through.
+    If on_line is given, stdout is passed to it line by line as it is written
+    instead of being returned.
+    """
+    module = load_test_module(test_type)
+    saved_environ = dict(os.environ)
+    root = logging.getLogger()
+    saved_handlers = root.handlers[:]
+    saved_level = root.level
+    out = LineStream(on_line) if on_line else io.StringIO()
+    err = io.StringIO() if capture_stderr else sys.stderr
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                module.main(argv)
+                returncode = 0
+            except SystemExit as e:
+                if e.code is None:
+                    returncode = 0
+                elif isinstance(e.code, int):
+                    returncode = e.code & 0xff # as seen by the parent of a real process
+                else:
+                    print(e.code, file=sys.stderr)
+                    returncode = 1
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+                returncode = 1
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        deterministic.restore()
+        root.handlers[:] = saved_handlers
+        root.setLevel(saved_level)
+    return returncode, '' if on_line else out.getvalue(), err.getvalue() if capture_stderr else None
@@ -22,25 +22,81 @@ Ponymail 12:
 
     def compute_updates(self, lid, private, msg):
 
+Archiver.compute_many pushes a stream of messages through the archiver, with
+the version dispatch done once rather than for every message.
 """
 
 import sys
 import inspect
+import itertools
+import queue
+import threading
+
+# Signatures are cached per Archiver class, as the wrapper is constructed
+# for every generator of every spec when running tests in-process
+_signatures = {}
+
+_END = object() # end of the items read by _prefetch
+
+def _prefetch(items, depth):
+    """Yields the items, reading up to depth of them ahead in a background thread"""
+    pending = queue.Queue(depth)
+    stop = threading.Event()
+    def put(entry):
+        while not stop.is_set():
+            try:
+                pending.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def read():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except BaseException as e: # pylint: disable=broad-except
+            put((_END, e))
+    thread = threading.Thread(target=read, name='compute_many prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = pending.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def _signature(archiver_):
+    cls = archiver_.Archiver
+    if cls not in _signatures:
+        _signatures[cls] = (inspect.signature(cls).parameters,
+                            inspect.signature(cls.compute_updates).parameters,
+                            inspect.signature(cls.list_url).parameters if hasattr(cls, 'list_url') else {})
+    return _signatures[cls]
 
 class Archiver(object):
     def __init__(self, archiver_, args):
-        self.expected_archie_parameters = inspect.signature(archiver_.Archiver).parameters
-        self.expected_compute_parameters = inspect.signature(archiver_.Archiver.compute_updates).parameters
+        self.expected_archie_parameters, self.expected_compute_parameters, list_url_parameters = _signature(archiver_)
 
+        self.archiver_module = archiver_
+        self.archiver_generator = None
+        self.generator = getattr(args, 'generator', None)
+        self.parse_html = args.parse_html
         # <= 0.11:
         if 'parseHTML' in self.expected_archie_parameters:
             if hasattr(args, 'generator'):
                 archiver_.archiver_generator = args.generator
+                self.archiver_generator = args.generator
             self.archie = archiver_.Archiver(parseHTML=args.parse_html)
-            params = inspect.signature(archiver_.Archiver.list_url).parameters
-            if '_mlist' in params:
+            if '_mlist' in list_url_parameters:
                 self.version = 'v0.11'
-            elif 'mlist' in params:
+            elif 'mlist' in list_url_parameters:
                 self.version = 'v0.10'
             else:
                 self.version = '?'
@@ -76,4 +132,33 @@ class Archiver(object):
         return self.archie.compute_updates(lid, private, message)[0]
 
     def compute_updates(self, fake_args, lid, private, message, message_raw):
+        if self.archiver_generator is not None:
+            # The generator is a module global in <= 0.11, so another instance may have changed it
+            self.archiver_module.archiver_generator = self.archiver_generator
         return self.compute(fake_args, lid, private, message, message_raw)
+
+    def compute_many(self, fake_args, items, private=False, chunk=1, prefetch=0):
+        """
+        Yields (item, result) for each (lid, message, message_raw, ...) item, as compute_updates would
+        give for it; anything in an item after the raw message is just passed through.
+        The items are computed chunk at a time, and with prefetch, up to that many items are read from
+        the iterable in a background thread while the archiver runs, so reading the next messages
+        overlaps computing the current ones. The iterable must then not share state with the caller.
+        """
+        if prefetch:
+            items = _prefetch(items, prefetch)
+        items = iter(items)
+        compute_updates = self.archie.compute_updates
+        while True:
+            batch = list(itertools.islice(items, chunk))
+            if not batch:
+                return
+            if self.archiver_generator is not None: # as compute_updates, but only once per chunk
+                self.archiver_module.archiver_generator = self.archiver_generator
+            if self.compute == self._compute_foal:
+                results = [compute_updates(item[0], private, item[1], item[2])[0] for item in batch]
+            elif self.compute == self._compute_12:
+                results = [compute_updates(fake_args, item[0], private, item[1])[0] for item in batch]
+            else:
+                results = [compute_updates(item[0], private, item[1])[0] for item in batch]
+            yield from zip(batch, results)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Persistent offset index for mbox corpus files.
+
+mailbox.mbox scans the whole file for 'From ' separators every time it is
+opened, and the test scripts open each corpus file once per generator.
+This module saves the table of contents to a sidecar file next to the corpus
+(<mbox>.idx), together with the Message-ID and Date header of each message,
+so that the [SEQ?] and --skipnodate checks do not need to parse the message.
+Compressed corpus files (see compressed.py) are indexed by their decompressed
+offsets, and messages are read from them through their block index.
+
+The sidecar is keyed by the size, mtime and SHA-256 of the corpus file.
+A size change always rebuilds the index; an mtime change only rebuilds it if
+the content hash differs as well. If the sidecar cannot be written (e.g. a
+read-only checkout) the index is rebuilt in memory for each process.
+
+To use:
+
+from mbox_index import IndexedMbox
+mbox = IndexedMbox(filename, MboxoFactory)
+for key in mbox.keys(): ... mbox.message_id(key), mbox.date(key)
+"""
+
+import email.parser
+import hashlib
+import io
+import json
+import mailbox
+import os
+
+import compressed
+from mboxo_patch import MboxoFactory, MboxoReader, MboxoMmapReader, FROM_MANGLED
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx'
+
+_indexes = {} # already loaded in this process, by (path, size, mtime)
+
+
+def _file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _header(msg, name):
+    value = msg.get(name)
+    return None if value is None else str(value)
+
+
+def build(path):
+    """Scans an mbox file and returns its index as a dict"""
+    mbox = compressed.open_mbox(path)
+    try:
+        mbox.keys() # generates the table of contents
+        messages = []
+        nomboxo = {}
+        parser = email.parser.BytesParser()
+        for key, (start, stop) in sorted(mbox._toc.items()): # pylint: disable=protected-access
+            # Headers are parsed as the test scripts do: with the From line dropped and mboxo unmangled
+            file = mbox.get_file(key)
+            headers = parser.parse(MboxoReader(file), headersonly=True)
+            messages.append([start, stop, _header(headers, 'message-id'), _header(headers, 'date')])
+            file = mbox.get_file(key)
+            head = file.read(stop - start)
+            if FROM_MANGLED in head.split(b'\n\n', 1)[0]:
+                # The headers differ without mboxo processing
+                file = mbox.get_file(key)
+                headers = parser.parse(file, headersonly=True)
+                nomboxo[str(key)] = [_header(headers, 'message-id'), _header(headers, 'date')]
+    finally:
+        mbox.close()
+    return {'messages': messages, 'nomboxo': nomboxo}
+
+
+def _save(sidecar, index):
+    try:
+        with open(sidecar + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(sidecar + '.tmp', sidecar)
+    except OSError:
+        pass # index is still usable in memory
+
+
+def load(path):
+    """Returns the index for an mbox file, from the sidecar if it is still valid"""
+    st = os.stat(path)
+    cache_key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    if cache_key in _indexes:
+        return _indexes[cache_key]
+    sidecar = path + INDEX_SUFFIX
+    index = None
+    try:
+        with open(sidecar, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if index is not None:
+        if index.get('version') != INDEX_VERSION or index.get('size') != st.st_size:
+            index = None
+        elif index.get('mtime') != st.st_mtime_ns:
+            sha = _file_hash(path)
+            if sha == index.get('sha256'):
+                index['mtime'] = st.st_mtime_ns # touched but unchanged
+                _save(sidecar, index)
+            else:
+                index = None
+    if index is None:
+        sha = _file_hash(path)
+        index = build(path)
+        index.update({'version': INDEX_VERSION, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': sha})
+        _save(sidecar, index)
+    _indexes[cache_key] = index
+    return index
+
+
+class IndexedMbox(mailbox.mbox):
+    """Read-only mbox whose table of contents comes from the sidecar index"""
+    def __init__(self, path, factory=None, nomboxo=False):
+        super().__init__(path, factory, create=False)
+        compressed.use_decompressed(self)
+        self.index = load(path)
+        self.nomboxo = nomboxo
+        self._toc = {key: (entry[0], entry[1]) for key, entry in enumerate(self.index['messages'])}
+        self._next_key = len(self._toc)
+        self._file_length = self.index['size']
+        self._reader = None
+
+    def get_bytes(self, key, from_=False):
+        """
+        Returns the message bytes read from a memory map (or the block index of a compressed file),
+        with mboxo unmangling unless nomboxo is set.
+        The result is the same as reading get_file(key, from_) through MboxoReader.
+        """
+        start, stop = self._lookup(key)
+        if self._reader is None:
+            if compressed.is_compressed(self._path):
+                self._reader = compressed.BlockReader(self._path)
+            else:
+                self._reader = MboxoMmapReader(self._path)
+        if not from_:
+            start = self._reader.next_line(start) # skip the From line, as get_file does
+        return self._reader.read(start, stop, not self.nomboxo)
+
+    def get_from_bytes(self, key, message_raw):
+        """
+        Returns the same message as get(key), parsed from message_raw as returned by
+        get_bytes(key, True) instead of reading and unmangling the message again.
+        """
+        eol = message_raw.find(b'\n') + 1 or len(message_raw)
+        from_line, body = message_raw[:eol], message_raw[eol:]
+        if self._factory is MboxoFactory and not self.nomboxo:
+            # The factory reads the message without its From line, so a '>From ' at the start is
+            # not preceded by a newline and stays mangled; it cannot be 'From ' in the mbox itself
+            if body.startswith(b'From '):
+                body = b'>' + body
+            msg = MboxoFactory.__new__(MboxoFactory)
+            mailbox.mboxMessage.__init__(msg, io.BytesIO(body)) # as MboxoFactory, without unmangling again
+            return msg
+        if self._factory is None and self.nomboxo:
+            # As mailbox.mbox.get_message
+            msg = self._message_factory(body.replace(mailbox.linesep, b'\n'))
+            msg.set_from(from_line.replace(mailbox.linesep, b'')[5:].decode('ascii'))
+            return msg
+        return self.get(key)
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        super().close()
+
+    def __len__(self):
+        return len(self._toc)
+
+    def _headers(self, key):
+        if self.nomboxo:
+            alt = self.index['nomboxo'].get(str(key))
+            if alt is not None:
+                return alt
+        return self.index['messages'][key][2:4]
+
+    def message_id(self, key):
+        """The Message-ID header as message.get('message-id') would return it"""
+        return self._headers(key)[0]
+
+    def date(self, key):
+        """The Date header as message.get('date') would return it"""
+        return self._headers(key)[1]
@@ -35,8 +35,15 @@ The return byte buffer can thus be larger than expected.
 However this is only a theoretical possibility
 as the mailbox code uses a size of 8192 (or None)
 
+MboxoMmapReader is an alternative for reading whole messages when their
+offsets are already known (e.g. from mbox_index). It memory-maps the file
+and unmangles each message in one pass, returning the same bytes as
+reading the message through MboxoReader.
+
 """
 import mailbox
+import mmap
+import os
 
 FROM_MANGLED  =b'\n>From '
 FROM_MANGLED_LEN=len(FROM_MANGLED)
@@ -95,3 +102,40 @@ class MboxoReader(mailbox._PartialFile): # pylint: disable=W0212
 class MboxoFactory(mailbox.mboxMessage):
     def __init__(self, message=None):
         super().__init__(message=MboxoReader(message))
+
+
+class MboxoMmapReader(object):
+    """Reads byte ranges of a memory-mapped mbox file, optionally with mboxo unmangling"""
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b'' # cannot map an empty file
+        self._view = memoryview(self._map)
+
+    def read(self, start, stop, unmangle=True):
+        """Returns the bytes from start to stop, replacing b'\n>From ' with b'\nFrom ' if unmangle is set"""
+        pos = self._map.find(FROM_MANGLED, start, stop) if unmangle else -1
+        if pos == -1:
+            return self._map[start:stop]
+        # Join the views either side of each '>' to be dropped, so the message is only copied once
+        parts = []
+        last = start
+        while pos != -1:
+            parts.append(self._view[last:pos + 1])
+            last = pos + 2
+            pos = self._map.find(FROM_MANGLED, pos + FROM_MANGLED_LEN, stop)
+        parts.append(self._view[last:stop])
+        return b''.join(parts)
+
+    def next_line(self, pos):
+        """Returns the offset of the line following the one at pos"""
+        eol = self._map.find(b'\n', pos)
+        return len(self._map) if eol == -1 else eol + 1
+
+    def close(self):
+        self._view.release()
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
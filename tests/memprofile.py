@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Memory profiling of the archiver, used by the --memprofile option.
+
+The peak memory allocated by Python (traced by tracemalloc) during each
+compute_updates call is recorded along with the size of the raw message,
+and the process peak RSS at the end of each test script (on Linux, reset at
+its start so it covers just that script in --inprocess workers). The report lists
+the messages which allocated the most relative to their raw size, which are
+the ones most likely to make an importer run out of memory.
+
+With --jsonl, the peak and raw size are added to each test record as
+"memory": {"peak": bytes, "raw": bytes}, and the peak RSS (in bytes) to the
+final record as "maxrss".
+"""
+
+import resource
+import sys
+import tracemalloc
+
+DEFAULT_TOP = 10
+
+
+def add_arguments(parser):
+    """Adds the memory profiling options to a test script or runall.py argument parser"""
+    parser.add_argument('--memprofile', dest='memprofile', action='store_true',
+                        help='Record the memory allocated by each compute_updates call and the peak RSS, and list '
+                             'the messages with the largest allocations relative to their size')
+    parser.add_argument('--memprofile-top', dest='memprofile_top', type=int, default=DEFAULT_TOP,
+                        help='Number of messages to list with --memprofile (default %u)' % DEFAULT_TOP)
+
+
+def reset_maxrss():
+    """Resets the peak RSS where possible (Linux), so it covers a single test run in --inprocess workers"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def maxrss():
+    """Peak resident set size of this process in bytes"""
+    try:
+        # Unlike ru_maxrss, this is not inherited across fork and exec from a larger parent
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+class MemProfiler(object):
+    def __init__(self):
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+        self.peak = None
+        reset_maxrss()
+
+    def call(self, fn):
+        """Returns fn(), raising self.peak to the most memory it allocated at any one time"""
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        try:
+            return fn()
+        finally:
+            self.peak = max(self.peak or 0, tracemalloc.get_traced_memory()[1] - current)
+
+    def close(self):
+        if self.started:
+            tracemalloc.stop()
+
+
+def report(records, top=DEFAULT_TOP, out=sys.stdout):
+    """Lists the records with the largest peak allocation relative to the raw message size"""
+    measured = [r for r in records if r.get('memory')]
+    measured.sort(key=lambda r: r['memory']['peak'] / max(1, r['memory']['raw']), reverse=True)
+    print("Largest compute_updates allocations relative to message size:", file=out)
+    print("%8s %10s %10s  %s" % ('ratio', 'peak KB', 'raw KB', 'message'), file=out)
+    for record in measured[:top]:
+        memory = record['memory']
+        print("%8.1f %10.1f %10.1f  %s %s%s %s" %
+              (memory['peak'] / max(1, memory['raw']), memory['peak'] / 1024.0, memory['raw'] / 1024.0,
+               record['mbox'], record['generator'] or record['type'],
+               '' if record.get('index') is None else ' index %u' % record['index'], record['message-id']), file=out)
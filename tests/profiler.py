@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Profiles the compute_updates calls of the test scripts, used by --profile.
+
+Only the time inside compute_updates is profiled, not the harness (yaml
+loading, mbox scanning etc). Each test type and generator is profiled
+separately, so the hot functions can be reported per generator; the
+combined stats are written as a pstats file, which can be read with
+python -m pstats or visualised with e.g. snakeviz or gprof2dot.
+
+runall.py passes --profile-dir to the test scripts, which then write one
+pstats file per test type and generator into that directory, to be merged
+by runall.py when all specs have run.
+"""
+
+import argparse
+import cProfile
+import glob
+import os
+import pstats
+import sys
+import tempfile
+
+DEFAULT_TOP = 10
+
+
+def add_arguments(parser):
+    """Adds the profiling options to a test script or runall.py argument parser"""
+    parser.add_argument('--profile', dest='profile', type=str, action='store',
+                        help='Profile the compute_updates calls, write the stats to this pstats file and list '
+                             'the hot functions in the Pony Mail sources')
+    parser.add_argument('--profile-top', dest='profile_top', type=int, default=DEFAULT_TOP,
+                        help='Number of hot functions to list per test type and generator with --profile '
+                             '(default %u)' % DEFAULT_TOP)
+    parser.add_argument('--profile-dir', dest='profile_dir', type=str, action='store',
+                        help=argparse.SUPPRESS) # used by runall.py
+
+
+class Profiler(object):
+    def __init__(self):
+        self.profiles = {}
+
+    def call(self, test_type, label, fn):
+        """Returns fn(), profiled under the given test type and label (generator)"""
+        profile = self.profiles.get((test_type, label))
+        if profile is None:
+            profile = self.profiles[(test_type, label)] = cProfile.Profile()
+        profile.enable()
+        try:
+            return fn()
+        finally:
+            profile.disable()
+
+    def stats(self):
+        """Returns {(test type, label): pstats.Stats}"""
+        return {key: pstats.Stats(profile) for key, profile in self.profiles.items()}
+
+    def dump(self, directory):
+        """Writes one pstats file per test type and label into directory, for merge()"""
+        for (test_type, label), profile in self.profiles.items():
+            fd, filename = tempfile.mkstemp(prefix='%s.%s.' % (test_type, label), suffix='.prof', dir=directory)
+            os.close(fd)
+            profile.dump_stats(filename)
+
+
+def merge(directory):
+    """Combines the files written by Profiler.dump into {(test type, label): pstats.Stats}"""
+    stats = {}
+    for filename in sorted(glob.glob(os.path.join(directory, '*.prof'))):
+        test_type, label = os.path.basename(filename).split('.')[:2]
+        if (test_type, label) in stats:
+            stats[(test_type, label)].add(filename)
+        else:
+            stats[(test_type, label)] = pstats.Stats(filename)
+    return stats
+
+
+def write(stats, filename):
+    """Writes the combination of all the stats to a single pstats file"""
+    combined = pstats.Stats()
+    combined.add(*stats.values())
+    combined.dump_stats(filename)
+
+
+def report(stats, rootdir, top=DEFAULT_TOP, out=sys.stdout):
+    """Lists the functions with the most internal time in the Pony Mail sources, per test type and label"""
+    tools_dir = os.path.join(os.path.realpath(os.path.join(rootdir, 'tools')), '')
+    for (test_type, label), item in sorted(stats.items()):
+        functions = [(tt, ct, nc, func) for func, (cc, nc, tt, ct, callers) in item.stats.items()
+                     if os.path.realpath(func[0]).startswith(tools_dir)]
+        functions.sort(reverse=True)
+        print("Hot functions for %s%s:" % (test_type, '' if label == test_type else ' ' + label), file=out)
+        print("%10s %10s %9s  %s" % ('tottime', 'cumtime', 'calls', 'function'), file=out)
+        for tt, ct, nc, (filename, line, name) in functions[:top]:
+            print("%10.4f %10.4f %9u  %s:%u(%s)" % (tt, ct, nc, os.path.relpath(os.path.realpath(filename), tools_dir),
+                                                   line, name), file=out)
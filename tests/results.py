@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Structured test results.
+
+With --jsonl, the test scripts write one JSON record per line to stdout for
+every test, followed by a final record with the totals:
+
+{"spec": "yaml/x.yaml", "type": "generators", "generator": "full", "mbox": "corpus/x.mbox",
+ "index": 0, "message-id": "<...>", "status": "pass", "time": 0.0012}
+...
+{"spec": "yaml/x.yaml", "type": "generators", "event": "done", "tests": 10, "failed": 0, "skipped": 0}
+
+status is one of pass, fail, skip or seq (message-id mismatch, not counted as a failure).
+time is the wall time of the compute_updates call in seconds, or null if it was not called
+(with --bench, the median of the timed calls). version is the detected Pony Mail version.
+generator is null for parsing tests. --memprofile adds memory usage (see memprofile.py)
+and --importprofile the import and startup costs (see importprofile.py).
+
+Without --jsonl, the traditional [PASS]/[DONE] text lines are printed instead.
+This module also has the report writers used by runall.py.
+"""
+
+import json
+import sys
+import xml.etree.ElementTree as ET
+
+
+class Reporter(object):
+    def __init__(self, args, test_type):
+        self.jsonl = getattr(args, 'jsonl', False)
+        self.spec = args.load
+        self.test_type = test_type
+
+    def test(self, generator, mboxfile, index, msgid, status, elapsed=None, text=None, version=None, memory=None):
+        """Reports a single test; text is the line to print in text mode, if any"""
+        if self.jsonl:
+            record = {'spec': self.spec, 'type': self.test_type, 'generator': generator, 'mbox': mboxfile,
+                      'index': index, 'message-id': msgid, 'status': status, 'time': elapsed, 'version': version}
+            if memory is not None:
+                record['memory'] = memory
+            print(json.dumps(record), flush=True)
+        elif text:
+            print(text)
+
+    def done(self, tests_run, errors, skipped, text, maxrss=None, imports=None):
+        if self.jsonl:
+            record = {'spec': self.spec, 'type': self.test_type, 'event': 'done',
+                      'tests': tests_run, 'failed': errors, 'skipped': skipped}
+            if maxrss is not None:
+                record['maxrss'] = maxrss
+            if imports is not None:
+                record['imports'] = imports
+            print(json.dumps(record), flush=True)
+        else:
+            print(text)
+
+
+def parse(line):
+    """Returns the record on a line of output, or None if it is not a record"""
+    if line.startswith('{'):
+        try:
+            return json.loads(line)
+        except ValueError:
+            pass
+    return None
+
+
+def slowest(records, count):
+    """The count slowest timed records, slowest first"""
+    timed = [r for r in records if r.get('time') is not None]
+    return sorted(timed, key=lambda r: r['time'], reverse=True)[:count]
+
+
+def write_json(filename, records, totals, specs=None, shard=None):
+    """
+    Writes a JSON report of every test. specs lists the outcome of each test type of each spec run,
+    and shard is the [I, N] of a runall.py --shard run, for tools/merge-shards.py.
+    """
+    report = {'totals': totals, 'tests': records}
+    if specs is not None:
+        report['specs'] = specs
+    if shard is not None:
+        report['shard'] = list(shard)
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+def summary(totals, seconds, out=sys.stdout):
+    """Prints the totals of a run"""
+    specs = totals['specs']
+    print("-------------------------------------", file=out)
+    print("Done with %u specification%s in %.2f seconds" % (specs, 's' if specs != 1 else '', seconds), file=out)
+    print("Specs processed: %4u" % specs, file=out)
+    print("Total tests run: %4u" % totals['run'], file=out)
+    print("Tests succeeded: %4u" % totals['succeeded'], file=out)
+    print("Tests failed:    %4u" % totals['failed'], file=out)
+    print("Tests skipped:   %4u" % totals['skipped'], file=out)
+    print("-------------------------------------", file=out)
+
+
+def write_junit(filename, records):
+    """Writes a JUnit XML report with one testsuite per spec file and test type"""
+    suites = {}
+    for record in records:
+        suites.setdefault((record['spec'], record['type']), []).append(record)
+    root = ET.Element('testsuites')
+    for (spec, test_type), tests in suites.items():
+        suite = ET.SubElement(root, 'testsuite', name="%s:%s" % (spec, test_type), tests=str(len(tests)),
+                              failures=str(sum(1 for t in tests if t['status'] == 'fail')),
+                              skipped=str(sum(1 for t in tests if t['status'] in ('skip', 'seq'))),
+                              time="%.6f" % sum(t['time'] or 0 for t in tests))
+        for test in tests:
+            classname = "%s.%s" % (test_type, test['generator']) if test['generator'] else test_type
+            case = ET.SubElement(suite, 'testcase', classname=classname,
+                                 name="%s index %u" % (test['mbox'], test['index']),
+                                 time="%.6f" % (test['time'] or 0))
+            if test['status'] == 'fail':
+                ET.SubElement(case, 'failure', message="Unexpected result for %s" % test['message-id'])
+            elif test['status'] == 'skip':
+                ET.SubElement(case, 'skipped', message="No date header")
+            elif test['status'] == 'seq':
+                ET.SubElement(case, 'skipped', message="Message-id mismatch")
+    ET.ElementTree(root).write(filename, encoding='utf-8', xml_declaration=True)
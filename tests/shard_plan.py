@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Deterministic split of the test suite across machines, used by --shard I/N.
+
+The messages tested by each spec and test type are laid end to end, in spec
+order and then in the order of messages() below, each weighted by its size
+in the corpus times the number of tests run on it. The sequence is then cut
+into N pieces of about the same weight, so each shard gets roughly the same
+number of corpus bytes to process however the specs are sized. Shard I runs
+only the messages of its piece: small specs usually fall entirely within one
+shard, large ones are split by message, and the test scripts are passed the
+range of messages to run with --message-range START:STOP.
+
+The split only depends on the specs and the corpus, so every machine agrees on
+it given the same options. tools/merge-shards.py combines the --json reports
+of all the shards into the totals and exit code of a single run.
+"""
+
+import argparse
+import collections
+
+import mbox_index
+import spec_loader
+
+
+def parse(text):
+    """Parses I/N (1 <= I <= N) into (I, N), for argparse"""
+    try:
+        i, n = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected I/N, e.g. 2/4, not '%s'" % text)
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError("shard %u/%u is out of range" % (i, n))
+    return i, n
+
+
+def parse_range(text):
+    """Parses START:STOP into (START, STOP), for argparse"""
+    try:
+        start, stop = [int(part) for part in text.split(':')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected START:STOP, e.g. 0:100, not '%s'" % text)
+    return start, stop
+
+
+def add_arguments(parser):
+    """Adds --message-range to a test script argument parser"""
+    parser.add_argument('--message-range', dest='message_range', type=parse_range,
+                        help='Only run the tests of messages START to STOP-1 of the spec, numbered as in '
+                             'shard_plan.messages() (used by runall.py --shard)')
+
+
+def messages(yml, test_type):
+    """The distinct (mbox file, index) tested by a test type of a spec in order, with the number of tests of each"""
+    counts = collections.OrderedDict()
+    mboxfiles = []
+    for file, run in yml[test_type].items():
+        mboxfiles.append(file)
+        if not run: # No tests under this filename, run same tests as next
+            continue
+        test_lists = run.values() if isinstance(run, dict) else [run] # tests per generator, or just tests
+        for mboxfile in mboxfiles:
+            for tests in test_lists:
+                for test in tests:
+                    key = (mboxfile, test['index'])
+                    counts[key] = counts.get(key, 0) + 1
+        mboxfiles = []
+    return list(counts.items())
+
+
+def selected(yml, test_type, message_range):
+    """The set of (mbox file, index) to test for --message-range, or None for all"""
+    if message_range is None:
+        return None
+    start, stop = message_range
+    return set(key for key, _ in messages(yml, test_type)[start:stop])
+
+
+def _weights(yml, test_type):
+    sizes = {}
+    weights = []
+    for (mboxfile, index), count in messages(yml, test_type):
+        if mboxfile not in sizes:
+            try:
+                sizes[mboxfile] = [stop - start for start, stop, _, _ in mbox_index.load(mboxfile)['messages']]
+            except OSError: # missing, which the test script will report
+                sizes[mboxfile] = []
+        size = sizes[mboxfile][index] if index < len(sizes[mboxfile]) else 0
+        weights.append(max(size, 1) * count)
+    return weights
+
+
+def plan(spec_files, shard, test_types=None):
+    """
+    Returns {(spec file, test type): (start, stop, messages)} for the message ranges run by the
+    shard (I, N), optionally only counting the given test types. Test types without any tests
+    are run by the first shard.
+    """
+    i, n = shard
+    sections = []
+    for spec_file in spec_files:
+        yml = spec_loader.load(spec_file)
+        for test_type in yml:
+            if test_type == 'args' or (test_types and test_type not in test_types):
+                continue
+            sections.append((spec_file, test_type, _weights(yml, test_type)))
+    total = sum(sum(weights) for _, _, weights in sections)
+    ranges = {}
+    before = 0
+    for spec_file, test_type, weights in sections:
+        if not weights:
+            if i == 1:
+                ranges[(spec_file, test_type)] = (0, 0, 0)
+            continue
+        owned = []
+        for pos, weight in enumerate(weights):
+            # A message belongs to the shard its midpoint falls in; integers keep every machine in agreement
+            if (2 * before + weight) * n // (2 * total) == i - 1:
+                owned.append(pos)
+            before += weight
+        if owned:
+            ranges[(spec_file, test_type)] = (owned[0], owned[-1] + 1, len(weights))
+    return ranges
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Runs the tests of a single spec (or generates one) in a pool of worker
+processes, used by --workers.
+
+The tests for each mbox file are split into contiguous ranges (chunks), which
+are run by the workers in any order. Each worker imports the archiver once
+and runs its chunks with stdout and stderr captured; the test script then
+replays the output and merges the counts chunk by chunk in the original
+order, so the output, the --dropin rewrite and the [DONE] counts are the same
+as for a serial run.
+
+A test script supports this by providing worker_run(argv), which returns an
+object for the worker with a method run_chunk(*chunk) that runs the tests of
+one chunk and returns whatever the script needs to merge its results.
+The same goes for generating a spec with --generate, for which results()
+runs a stream of chunks a limited distance ahead of their consumer.
+
+To use:
+
+pool = shards.Pool('generators', argv, args.workers)
+future = pool.submit(chunk)
+...
+out, err, result = future.result()
+pool.close()
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import logging
+import sys
+
+import inprocess
+
+CHUNKS_PER_WORKER = 4 # more chunks than workers, so that slow chunks do not hold everything up
+
+_run = None # this worker's test run
+
+
+def add_arguments(parser):
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Split the tests of each mbox file across this many worker processes (default 1)')
+
+
+def split(count, workers):
+    """Returns the (start, stop) ranges to split count tests into for the given number of workers"""
+    chunks = min(count, workers * CHUNKS_PER_WORKER) or 1
+    bounds = [count * i // chunks for i in range(chunks + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(chunks)]
+
+
+def _init_worker(test_type, argv):
+    global _run
+    _run = inprocess.load_test_module(test_type).worker_run(argv)
+
+
+def _run_chunk(chunk):
+    out = io.StringIO()
+    err = io.StringIO()
+    root = logging.getLogger()
+    saved_handlers = root.handlers[:]
+    root.handlers[:] = [logging.StreamHandler(err)] # archiver log messages belong with the chunk's output
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            result = _run.run_chunk(*chunk)
+    finally:
+        root.handlers[:] = saved_handlers
+    return out.getvalue(), err.getvalue(), result
+
+
+class Pool(object):
+    def __init__(self, test_type, argv, workers):
+        self.workers = workers
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                               initargs=(test_type, argv))
+
+    def submit(self, chunk):
+        """Starts running a chunk; the future's result is (stdout, stderr, result of run_chunk)"""
+        return self.executor.submit(_run_chunk, chunk)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+def results(run, chunks, pool=None, ahead=None):
+    """
+    Yields run.run_chunk(*chunk) for each of the chunks in order. With a pool, the chunks are
+    run by its workers up to ahead chunks (by default CHUNKS_PER_WORKER per worker) in advance,
+    and the output of each is written out before its result is yielded.
+    """
+    if pool is None:
+        for chunk in chunks:
+            yield run.run_chunk(*chunk)
+        return
+    chunks = iter(chunks)
+    pending = collections.deque(pool.submit(chunk)
+                                for chunk in itertools.islice(chunks, ahead or pool.workers * CHUNKS_PER_WORKER))
+    while pending:
+        out, err, result = pending.popleft().result()
+        for chunk in itertools.islice(chunks, 1):
+            pending.append(pool.submit(chunk))
+        sys.stdout.write(out)
+        sys.stdout.flush()
+        sys.stderr.write(err)
+        yield result
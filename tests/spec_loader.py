@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Loads yaml test specs, with a cache shared by runall.py and the test scripts.
+
+Specs are parsed with the libyaml C loader when PyYAML has it, and the result
+is saved next to the spec as a pickle (<spec>.cache). In the cache, lists of
+test entries are stored as tables: the distinct key tuples once, then one
+tuple of values per entry, with all strings interned. The message-ids that
+repeat for every generator are thus only stored once.
+
+The cache is keyed by the size, mtime and SHA-256 of the spec; if only the
+mtime has changed, the content hash decides. load() always returns a new
+copy, so callers may modify it (e.g. --dropin). Specs already loaded are also
+kept in memory, so a long-lived process (--inprocess, --watch) only reads each
+spec again when it changes.
+
+To use:
+
+import spec_loader
+yml = spec_loader.load(filename)   # same result as yaml.safe_load
+"""
+
+import hashlib
+import os
+import pickle
+import sys
+
+import yaml
+
+CACHE_VERSION = 1
+CACHE_SUFFIX = '.cache'
+
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+_specs = {} # already loaded in this process: path -> (size, mtime, encoded spec)
+
+
+def _encode(obj):
+    if isinstance(obj, dict):
+        return {sys.intern(k) if isinstance(k, str) else k: _encode(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        if obj and all(isinstance(entry, dict) for entry in obj):
+            # A table: (key tuples, rows of (key tuple index, values...))
+            keysets = {}
+            rows = []
+            for entry in obj:
+                keys = tuple(sys.intern(k) if isinstance(k, str) else k for k in entry)
+                rows.append((keysets.setdefault(keys, len(keysets)),) + tuple(_encode(v) for v in entry.values()))
+            return (tuple(keysets), tuple(rows))
+        return [_encode(v) for v in obj]
+    if isinstance(obj, str):
+        return sys.intern(obj)
+    return obj
+
+
+def _decode(obj):
+    if isinstance(obj, dict):
+        return {k: _decode(v) for k, v in obj.items()}
+    if isinstance(obj, tuple):
+        keysets, rows = obj
+        return [dict(zip(keysets[row[0]],
+                         [_decode(v) if isinstance(v, (dict, list, tuple)) else v for v in row[1:]]))
+                for row in rows]
+    if isinstance(obj, list):
+        return [_decode(v) for v in obj]
+    return obj
+
+
+def _hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def load(path):
+    """Returns the parsed yaml spec, from the cache if it is still valid"""
+    st = os.stat(path)
+    realpath = os.path.realpath(path)
+    loaded = _specs.get(realpath)
+    if loaded is not None and loaded[:2] == (st.st_size, st.st_mtime_ns):
+        return _decode(loaded[2])
+    cache_file = path + CACHE_SUFFIX
+    cached = None
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('version') != CACHE_VERSION or cached.get('size') != st.st_size:
+            cached = None
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError):
+        cached = None
+    if cached is not None and cached.get('mtime') == st.st_mtime_ns:
+        _specs[realpath] = (st.st_size, st.st_mtime_ns, cached['spec'])
+        return _decode(cached['spec'])
+    with open(path, 'rb') as f:
+        data = f.read()
+    sha = _hash(data)
+    if cached is not None and cached.get('sha256') == sha:
+        spec = cached['spec'] # touched but unchanged
+    else:
+        spec = _encode(yaml.load(data, Loader=SafeLoader))
+    try:
+        with open(cache_file + '.tmp', 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'size': st.st_size, 'mtime': st.st_mtime_ns,
+                         'sha256': sha, 'spec': spec}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + '.tmp', cache_file)
+    except OSError:
+        pass # still works without a cache
+    _specs[realpath] = (st.st_size, st.st_mtime_ns, spec)
+    return _decode(spec)
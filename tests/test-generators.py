@@ -5,13 +5,21 @@ It tests live generated IDs against a set of predefined reference constants.
 """
 import sys
 import os
-import mailbox
 import yaml
 import argparse
 import collections
+import copy
 import interfacer
+import results
+import mbox_index
+import spec_loader
+import compute as compute_
+import importprofile
+import shards
+import shard_plan
+import yaml_stream
+import deterministic
 import time
-import email.utils
 
 parse_html = False
 nonce = None
@@ -19,7 +27,9 @@ fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody'])(False, None
 
 # get raw message, allowing for mboxo translation
 def _raw(args, mbox, key):
-    if args.nomboxo: # No need to filter the data
+    if isinstance(mbox, mbox_index.IndexedMbox): # read from a memory map, translating as needed
+        message_raw=mbox.get_bytes(key, True)
+    elif args.nomboxo: # No need to filter the data
         file=mbox.get_file(key, True)
         message_raw=file.read()
         file.close()
@@ -31,34 +41,64 @@ def _raw(args, mbox, key):
         file.close()
     return message_raw
 
-def generate_specs(args):
-    if not args.nomboxo:
-        # Temporary patch to fix Python email package limitation
-        # It must be removed when the Python package is fixed
-        from mboxo_patch import MboxoFactory
-    import archiver
-    if args.generators:
-        generator_names = args.generators
-    else:
-        try:
-            import generators
-        except:
-            import plugins.generators as generators
-        generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
-    yml = {}
-    # sort so most recent generators come last to make comparisons easier
-    for gen_type in sorted(generator_names, key=lambda s: s.replace('dkim','zkim')):
-        test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(parse_html, gen_type)
-        archie = interfacer.Archiver(archiver, test_args)
-        sys.stderr.write("Generating specs for type '%s'...\n" % gen_type)
+def _read(args, mbox, key):
+    """Returns the raw bytes and the parsed message, parsing the bytes rather than reading the message again"""
+    message_raw = _raw(args, mbox, key)
+    if isinstance(mbox, mbox_index.IndexedMbox):
+        return message_raw, mbox.get_from_bytes(key, message_raw)
+    return message_raw, mbox.get(key)
+
+GENERATE_CHUNK = 100 # messages per chunk with --generate
+
+
+def _cmd(argv):
+    """The command to record in a generated spec; --workers does not change the output, so is left out"""
+    cmd = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--workers':
+            skip = True
+        elif not arg.startswith('--workers='):
+            cmd.append(arg)
+    return " ".join(cmd)
 
+
+class SpecGenerator(object):
+    """Computes the spec entries of chunks of the mbox; with --workers, in each worker process"""
+    def __init__(self, args):
+        if not args.nomboxo:
+            # Temporary patch to fix Python email package limitation
+            # It must be removed when the Python package is fixed
+            from mboxo_patch import MboxoFactory
+        import archiver
+        deterministic.apply()
+        self.args = args
+        self.archiver = archiver
+        self.factory = None if args.nomboxo else MboxoFactory
+        self.archivers = {}
+        self.mbox = None
+
+    def run_chunk(self, gen_type, start, stop):
+        """Returns the entries for messages start to stop-1 for a generator"""
+        args = self.args
+        if start == 0:
+            sys.stderr.write("Generating specs for type '%s'...\n" % gen_type)
+        if gen_type not in self.archivers:
+            test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(parse_html, gen_type)
+            self.archivers[gen_type] = interfacer.Archiver(self.archiver, test_args)
+        archie = self.archivers[gen_type]
+        if self.mbox is None:
+            self.mbox = mbox_index.IndexedMbox(args.mboxfile, self.factory, args.nomboxo)
+        mbox = self.mbox
+        def read():
+            for key in range(start, stop):
+                message_raw, message = _read(args, mbox, key)
+                lid = args.lid or self.archiver.normalize_lid(message.get('list-id', '??'))
+                yield lid, message, message_raw, key
         gen_spec = []
-        mbox = mailbox.mbox(args.mboxfile, None if args.nomboxo else MboxoFactory, create=False)
-        for key in mbox.keys():
-            message_raw = _raw(args, mbox, key)
-            message = mbox.get(key)
-            lid = args.lid or archiver.normalize_lid(message.get('list-id', '??'))
-            json = archie.compute_updates(fake_args, lid, False, message, message_raw)
+        for (lid, message, message_raw, key), json in archie.compute_many(fake_args, read(), chunk=GENERATE_CHUNK):
             mid = message.get('message-id','').strip()
             if json:
                 gen_spec.append({
@@ -68,109 +108,332 @@ def generate_specs(args):
                 })
             else:
                 print("Cannot parse index %d: %s" % (key, mid))
-        yml[gen_type] = gen_spec
-    with open(args.generate, 'w') as f:
-        # don't sort keys here
-        yaml.dump({'args': {'cmd': " ".join(sys.argv)}, 'generators': {args.mboxfile: yml}}, f, sort_keys=False)
-        f.close()
-
-
-def run_tests(args):
-    if not args.nomboxo:
-        # Temporary patch to fix Python email package limitation
-        # It must be removed when the Python package is fixed
-        from mboxo_patch import MboxoFactory
-    import archiver
-    import logging
-    verbose_logger = logging.getLogger()
-    verbose_logger.setLevel(logging.WARN)
-    verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
-    archiver.logger = verbose_logger
-
-    try:
-        import generators
-    except:
-        import plugins.generators as generators
-    errors = 0
-    skipped = 0
-    tests_run = 0
-    yml = yaml.safe_load(open(args.load, 'r'))
-    _env = {}
-    if 'args' in yml and 'env' in yml['args']:
-        _env = yml['args']['env']
-    generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
+        return gen_spec
+
+
+def generate_specs(args, argv):
+    """
+    Writes the spec as the entries are computed, in chunks of messages which are shared
+    out among the --workers; the output is the same as a yaml.dump of the whole spec
+    """
     if args.generators:
         generator_names = args.generators
-    mboxfiles = []
-    for file, run in yml['generators'].items():
-        mboxfiles.append(file)
-        if not run: # No tests under this filename, run same tests as next
-            continue
-        for gen_type, tests in run.items():
-            if gen_type not in generator_names:
-                sys.stderr.write("Warning: generators.py does not have the '%s' generator, skipping tests\n" % gen_type)
+    else:
+        try:
+            import generators
+        except:
+            import plugins.generators as generators
+        generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
+    run = SpecGenerator(args)
+    count = len(mbox_index.load(args.mboxfile)['messages'])
+    chunks = []
+    # sort so most recent generators come last to make comparisons easier
+    for gen_type in sorted(generator_names, key=lambda s: s.replace('dkim','zkim')):
+        chunks.extend((gen_type, start, min(start + GENERATE_CHUNK, count))
+                      for start in range(0, count or 1, GENERATE_CHUNK))
+    pool = shards.Pool('generators', argv, args.workers) if args.workers > 1 else None
+    with open(args.generate + '.tmp', 'w') as f:
+        # don't sort keys here
+        out = yaml_stream.Writer(f)
+        out.start_mapping()
+        out.value('args')
+        out.value({'cmd': _cmd(sys.argv)})
+        out.value('generators')
+        out.start_mapping()
+        out.value(args.mboxfile)
+        out.start_mapping()
+        previous = None
+        for (gen_type, _, _), entries in zip(chunks, shards.results(run, chunks, pool)):
+            if gen_type != previous:
+                if previous is not None:
+                    out.end_sequence()
+                out.value(gen_type)
+                out.start_sequence()
+                previous = gen_type
+            for entry in entries:
+                out.value(entry)
+        if previous is not None:
+            out.end_sequence()
+        out.end_mapping()
+        out.end_mapping()
+        out.end_mapping()
+        out.close()
+    os.replace(args.generate + '.tmp', args.generate)
+    if pool:
+        pool.close()
+
+
+class TestRun(object):
+    """
+    The state of a run of the tests in a spec. With --workers, each worker process
+    has its own, which runs chunks of the tests for the main process to merge.
+    """
+    def __init__(self, args, worker=False):
+        if not args.nomboxo:
+            # Temporary patch to fix Python email package limitation
+            # It must be removed when the Python package is fixed
+            from mboxo_patch import MboxoFactory
+        self.imports = importprofile.from_args(args)
+        with importprofile.phase(self.imports, importprofile.IMPORT):
+            import archiver
+        import logging
+        verbose_logger = logging.getLogger()
+        verbose_logger.setLevel(logging.WARN)
+        if not worker: # shards.py directs the log of workers to the output of each chunk
+            verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
+        archiver.logger = verbose_logger
+
+        with importprofile.phase(self.imports, importprofile.IMPORT):
+            try:
+                import generators
+            except:
+                import plugins.generators as generators
+        deterministic.apply()
+        self.args = args
+        self.archiver = archiver
+        self.factory = None if args.nomboxo else MboxoFactory
+        self.errors = 0
+        self.skipped = 0
+        self.tests_run = 0
+        self.report = results.Reporter(args, 'generators')
+        self.compute = compute_.Compute(args, 'generators', self.imports)
+        self.yml = spec_loader.load(args.load)
+        self._env = {}
+        if 'args' in self.yml and 'env' in self.yml['args']:
+            self._env = self.yml['args']['env']
+        self.generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
+        if args.generators:
+            self.generator_names = args.generators
+        self.selected = shard_plan.selected(self.yml, 'generators', args.message_range)
+        self.archivers = {} # per generator, in workers
+        self.mboxes = {} # per mbox file, in workers
+
+    def new_archiver(self, gen_type):
+        test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(parse_html, gen_type)
+        return importprofile.first(self.imports, importprofile.CONSTRUCT, gen_type,
+                                   lambda: interfacer.Archiver(self.archiver, test_args))
+
+    def run_test(self, gen_type, archie, mboxfile, mbox, test, read):
+        """Runs a single test; read(key) returns the raw and parsed message"""
+        args = self.args
+        report = self.report
+        self.tests_run += 1
+        key = test['index']
+        # Checked against the index, so skipped tests need not be read and parsed
+        msgid =(mbox.message_id(key) or '').strip()
+        dateheader = mbox.date(key)
+        if args.skipnodate and not dateheader:
+            report.test(gen_type, mboxfile, key, msgid, 'skip',
+                        text="""[SKIP] %s, index %2u: No date header found and --skipnodate specified, skipping this test!""" %
+                             (gen_type, key, ))
+            self.skipped += 1
+            return
+        if msgid != test['message-id']:
+            sys.stderr.write("""[SEQ?] %s, index %2u: Expected '%s', got '%s'!\n""" %
+                            (gen_type, key, test['message-id'], msgid))
+            report.test(gen_type, mboxfile, key, msgid, 'seq')
+            return # no point continuing
+        message_raw, message = read(key)
+        mock_aat = None
+        # Mock archived-at for slightly broken medium generators
+        if 'MOCK_AAT' in self._env and gen_type == 'medium':
+            if args.singlepass: # don't change the message seen by the other generators
+                message = copy.deepcopy(message)
+            mock_aat = deterministic.archived_at(self._env)
+            try:
+                message.replace_header('archived-at', mock_aat)
+            except:
+                message['archived-at'] = mock_aat
+        lid = args.lid or self.archiver.normalize_lid(message.get('list-id', '??'))
+        json, elapsed = self.compute(archie, gen_type, mboxfile, (lid, mock_aat), fake_args, lid, False, message, message_raw)
+
+        # get override for version (if any)
+        expected = test.get(archie.version, test['generated'])
+        actual = json['mid']
+        if actual != expected:
+            self.errors += 1
+            sys.stderr.write("""[FAIL] %s, index %2u: Expected '%s', got '%s'!\n""" %
+                            (gen_type, key, expected, actual))
+            report.test(gen_type, mboxfile, key, msgid, 'fail', elapsed, version=archie.version, memory=self.compute.memory)
+            if args.dropin and gen_type == args.dropin:
+                if expected != actual:
+                    test['generated'] = actual
+                else:
+                    test['alternate'] = actual
+        else:
+            report.test(gen_type, mboxfile, key, msgid, 'pass', elapsed, "[PASS] %s index %u" % (gen_type, key),
+                        archie.version, self.compute.memory)
+
+    def check_count(self, gen_type, mboxfile, mbox, tests):
+        no_messages = len(mbox)
+        no_tests = len(tests)
+        if no_messages != no_tests:
+            sys.stderr.write("Warning: %s run for %s contains %u tests, but mbox file has %u emails!\n" %
+                            (gen_type, mboxfile, no_tests, no_messages))
+
+    def sections(self):
+        """
+        Yields the tests in the order they are run: (mbox file, yaml key of its tests, generators)
+        for each mbox file and generator, or for each mbox file with --singlepass.
+        Warnings about unknown generators are yielded as text.
+        """
+        mboxfiles = []
+        for file, run in self.yml['generators'].items():
+            mboxfiles.append(file)
+            if not run: # No tests under this filename, run same tests as next
                 continue
-            test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(parse_html, gen_type)
-            archie = interfacer.Archiver(archiver, test_args)
-            for mboxfile in mboxfiles:
-                sys.stderr.write("Starting to process %s using %s\n" % (mboxfile,gen_type))
-                mbox = mailbox.mbox(mboxfile, None if args.nomboxo else MboxoFactory, create=False)
-                no_messages = len(mbox.keys())
-                no_tests = len(tests)
-                if no_messages != no_tests:
-                    sys.stderr.write("Warning: %s run for %s contains %u tests, but mbox file has %u emails!\n" %
-                                    (gen_type, mboxfile, no_tests, no_messages))
-                for test in tests:
-                    tests_run += 1
-                    key = test['index']
-                    message_raw = _raw(args, mbox, key)
-                    message = mbox.get(key)
-                    # Mock archived-at for slightly broken medium generators
-                    if 'MOCK_AAT' in _env and gen_type == 'medium':
-                        mock_aat = email.utils.formatdate(int(_env['MOCK_AAT']), False)
-                        try:
-                            message.replace_header('archived-at', mock_aat)
-                        except:
-                            message['archived-at'] = mock_aat
-                    msgid =(message.get('message-id') or '').strip()
-                    dateheader = message.get('date')
-                    if args.skipnodate and not dateheader:
-                        print("""[SKIP] %s, index %2u: No date header found and --skipnodate specified, skipping this test!""" %
-                                         (gen_type, key, ))
-                        skipped += 1
-                        continue
-                    if msgid != test['message-id']:
-                        sys.stderr.write("""[SEQ?] %s, index %2u: Expected '%s', got '%s'!\n""" %
-                                        (gen_type, key, test['message-id'], msgid))
-                        continue # no point continuing
-                    lid = args.lid or archiver.normalize_lid(message.get('list-id', '??'))
-                    json = archie.compute_updates(fake_args, lid, False, message, message_raw)
-
-                    # get override for version (if any)
-                    expected = test.get(archie.version, test['generated'])
-                    actual = json['mid']
-                    if actual != expected:
-                        errors += 1
-                        sys.stderr.write("""[FAIL] %s, index %2u: Expected '%s', got '%s'!\n""" %
-                                        (gen_type, key, expected, actual))
-                        if args.dropin and gen_type == args.dropin:
-                            if expected != actual:
-                                test['generated'] = actual
-                            else:
-                                test['alternate'] = actual
-                    else:
-                        print("[PASS] %s index %u" % (gen_type, key))
-        mboxfiles = [] # reset for the next set of tests
+            gen_types = []
+            for gen_type in run:
+                if gen_type not in self.generator_names:
+                    yield "Warning: generators.py does not have the '%s' generator, skipping tests\n" % gen_type
+                    continue
+                gen_types.append(gen_type)
+            if self.args.singlepass:
+                for mboxfile in mboxfiles:
+                    yield mboxfile, file, gen_types
+            else:
+                for gen_type in gen_types:
+                    for mboxfile in mboxfiles:
+                        yield mboxfile, file, [gen_type]
+            mboxfiles = [] # reset for the next set of tests
+
+    def tests(self, file, gen_type, mboxfile):
+        """The tests of a generator for an mbox file, less any outside --message-range"""
+        tests = self.yml['generators'][file][gen_type]
+        if self.selected is None:
+            return tests
+        return [test for test in tests if (mboxfile, test['index']) in self.selected]
+
+    def entries(self, file, gen_types, archivers, mboxfile, mbox=None):
+        """The (generator, archiver, test) of each test of a section, in the order they are run"""
+        if mbox is not None:
+            for gen_type in gen_types:
+                self.check_count(gen_type, mboxfile, mbox, self.yml['generators'][file][gen_type])
+        runs = [(gen_type, self.tests(file, gen_type, mboxfile), archivers[gen_type]) for gen_type in gen_types]
+        if not self.args.singlepass:
+            gen_type, tests, archie = runs[0]
+            return [(gen_type, archie, test) for test in tests]
+        # Read and parse each message once, then compute the IDs for every generator from it
+        by_key = collections.OrderedDict()
+        for gen_type, tests, archie in runs:
+            for test in tests:
+                by_key.setdefault(test['index'], []).append((gen_type, archie, test))
+        return [entry for entries in by_key.values() for entry in entries]
+
+    def reader(self, mbox):
+        """Returns read(key) for run_test, which caches the last message for --singlepass"""
+        args = self.args
+        if not args.singlepass:
+            return lambda key: _read(args, mbox, key)
+        cache = {}
+        def read(key):
+            if key not in cache:
+                cache.clear()
+                cache[key] = _read(args, mbox, key)
+            return cache[key]
+        return read
+
+    def run_chunk(self, mboxfile, file, gen_types, start, stop):
+        """Runs tests start to stop of a section in a worker; returns the counts and any --dropin changes"""
+        for gen_type in gen_types:
+            if gen_type not in self.archivers:
+                self.archivers[gen_type] = self.new_archiver(gen_type)
+        if mboxfile not in self.mboxes:
+            self.mboxes[mboxfile] = mbox_index.IndexedMbox(mboxfile, self.factory, self.args.nomboxo)
+        mbox = self.mboxes[mboxfile]
+        read = self.reader(mbox)
+        self.tests_run = self.errors = self.skipped = 0
+        cache = self.compute.cache
+        hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+        entries = self.entries(file, gen_types, self.archivers, mboxfile)[start:stop]
+        for gen_type, archie, test in entries:
+            self.run_test(gen_type, archie, mboxfile, mbox, test, read)
+        changed = [test for gen_type, _, test in entries] if self.args.dropin in gen_types else None
+        if cache:
+            hits, misses = cache.hits - hits, cache.misses - misses
+        return self.tests_run, self.errors, self.skipped, changed, hits, misses
+
+    def merge(self, out, err, result, entries, start):
+        """Adds the output and counts of a chunk run by a worker"""
+        sys.stdout.write(out)
+        sys.stdout.flush()
+        sys.stderr.write(err)
+        tests_run, errors, skipped, changed, hits, misses = result
+        self.tests_run += tests_run
+        self.errors += errors
+        self.skipped += skipped
+        if changed is not None:
+            for (_, _, test), new in zip(entries[start:], changed):
+                test.update(new)
+        if self.compute.cache:
+            self.compute.cache.hits += hits
+            self.compute.cache.misses += misses
+
+
+def run_tests(args, argv):
+    run = TestRun(args)
+    pool = None
+    if args.workers > 1:
+        pool = shards.Pool('generators', argv, args.workers)
+    sections = list(run.sections())
+    archivers = {}
+    futures = {}
+    if pool:
+        # Start every chunk now, the output is merged section by section below
+        for i, section in enumerate(sections):
+            if isinstance(section, str):
+                continue
+            mboxfile, file, gen_types = section
+            count = sum(len(run.tests(file, gen_type, mboxfile)) for gen_type in gen_types)
+            futures[i] = [(start, pool.submit((mboxfile, file, gen_types, start, stop)))
+                          for start, stop in shards.split(count, args.workers)]
+    previous_file = None
+    for i, section in enumerate(sections):
+        if isinstance(section, str):
+            sys.stderr.write(section)
+            continue
+        mboxfile, file, gen_types = section
+        if file != previous_file: # a new set of tests gets new archivers
+            archivers = {}
+            previous_file = file
+        for gen_type in gen_types:
+            if gen_type not in archivers:
+                archivers[gen_type] = run.new_archiver(gen_type)
+        sys.stderr.write("Starting to process %s using %s\n" % (mboxfile, ', '.join(gen_types)))
+        mbox = mbox_index.IndexedMbox(mboxfile, run.factory, args.nomboxo)
+        entries = run.entries(file, gen_types, archivers, mboxfile, mbox)
+        if pool:
+            for start, future in futures[i]:
+                run.merge(*future.result(), entries, start)
+        else:
+            read = run.reader(mbox)
+            for gen_type, archie, test in entries:
+                run.run_test(gen_type, archie, mboxfile, mbox, test, read)
+    if pool:
+        pool.close()
+    run.compute.close()
+    errors = run.errors
+    skipped = run.skipped
+    tests_run = run.tests_run
     if args.dropin and errors:
         sys.stderr.write("Writing replacement yaml as --dropin was specified\n")
-        yaml.safe_dump(yml, open(args.load, "w"), sort_keys=False)
-    # N.B. The following line is parsed by runall.py
-    print("[DONE] %u tests run, %u failed. Skipped %u." % (tests_run, errors, skipped))
+        yaml.safe_dump(run.yml, open(args.load, "w"), sort_keys=False)
+    run.report.done(tests_run, errors, skipped, "[DONE] %u tests run, %u failed. Skipped %u." % (tests_run, errors, skipped),
+                    run.compute.maxrss, run.compute.imports)
     if errors:
         sys.exit(-1)
 
 
-def main():
+def worker_run(argv):
+    """The TestRun or SpecGenerator for a --workers process (see shards.py)"""
+    args = parse_args(argv)
+    setup(args)
+    if args.generate:
+        return SpecGenerator(args)
+    return TestRun(args, worker=True)
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Command line options.')
     parser.add_argument('--generate', dest='generate', type=str,
                         help='Generate a test yaml spec, output to file specified here')
@@ -190,35 +453,41 @@ def main():
                         help = 'Perform drop-in replacement of unit test results for the specified generator type [devs only!]')
     parser.add_argument('--skipnodate', dest = 'skipnodate', action='store_true',
                         help = 'Skip emails with no Date: header (useful for medium generator tests)')
-    args = parser.parse_args()
+    parser.add_argument('--singlepass', dest = 'singlepass', action='store_true',
+                        help = 'Read and parse each message once and run all generator tests on it')
+    parser.add_argument('--jsonl', dest = 'jsonl', action='store_true',
+                        help = 'Write a JSON record per test to stdout instead of text (used by runall.py)')
+    compute_.add_arguments(parser)
+    shards.add_arguments(parser)
+    shard_plan.add_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.workers > 1 and (args.bench or args.profile or args.profile_dir or args.memprofile or args.importprofile):
+        parser.error('--workers cannot be combined with --bench, --profile, --memprofile or --importprofile')
+    return args
 
+
+def setup(args):
+    """Makes the Pony Mail tools importable"""
     if args.rootdir:
         tools_dir = os.path.join(args.rootdir, 'tools')
     else:
         tools_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', "tools")
-    sys.path.append(tools_dir)
-
-    if os.environ.get('MOCK_GMTIME'):
-        import time
-        import traceback
-        save_gmtime = time.gmtime
-        def _time_gmtime(secs=None):
-            if secs is None:
-                callers = traceback.extract_stack(limit=2) # want last-1 and last (i.e. here)
-                [filename, _, _, _] = callers[0] # This is last-1, i.e. my caller
-                if filename.endswith("/tools/archiver.py") or filename.endswith("tools/generators.py"):
-                    return save_gmtime(0)
-            return save_gmtime(secs)
-
-        time.gmtime = _time_gmtime
-    
+    if tools_dir not in sys.path:
+        sys.path.append(tools_dir)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    setup(args)
     if args.generate:
         if not args.mboxfile:
             sys.stderr.write("Generating a test spec requires an mbox filepath passed with --mbox!\n")
             sys.exit(-1)
-        generate_specs(args)
+        generate_specs(args, argv)
     elif args.load:
-        run_tests(args)
+        run_tests(args, argv)
 
 
 if __name__ == '__main__':
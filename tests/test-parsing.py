@@ -5,19 +5,28 @@ It tests live parsings against a set of predefined reference constants.
 """
 import sys
 import os
-import mailbox
-import yaml
 import argparse
 import collections
 import hashlib
 import interfacer
+import results
+import mbox_index
+import spec_loader
+import compute as compute_
+import importprofile
+import shards
+import shard_plan
+import yaml_stream
+import deterministic
 
 nonce = None
 fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody'])(False, None)
 
 # get raw message, allowing for mboxo translation
 def _raw(args, mbox, key):
-    if args.nomboxo: # No need to filter the data
+    if isinstance(mbox, mbox_index.IndexedMbox): # read from a memory map, translating as needed
+        message_raw=mbox.get_bytes(key, True)
+    elif args.nomboxo: # No need to filter the data
         file=mbox.get_file(key, True)
         message_raw=file.read()
         file.close()
@@ -29,25 +38,59 @@ def _raw(args, mbox, key):
         file.close()
     return message_raw
 
-def generate_specs(args):
-    if not args.nomboxo:
-        # Temporary patch to fix Python email package limitation
-        # It must be removed when the Python package is fixed
-        from mboxo_patch import MboxoFactory
-    import archiver
-    cli_args = collections.namedtuple('testargs', ['parse_html'])(args.html)
-    archie = interfacer.Archiver(archiver, cli_args)
+def _read(args, mbox, key):
+    """Returns the raw bytes and the parsed message, parsing the bytes rather than reading the message again"""
+    message_raw = _raw(args, mbox, key)
+    if isinstance(mbox, mbox_index.IndexedMbox):
+        return message_raw, mbox.get_from_bytes(key, message_raw)
+    return message_raw, mbox.get(key)
 
-    sys.stderr.write("Generating parsing specs for file '%s'...\n" % args.mboxfile)
-    items = {}
-    for mboxfile in args.mboxfile:
+GENERATE_CHUNK = 100 # messages per chunk with --generate
+
+
+def _cmd(argv):
+    """The command to record in a generated spec; --workers does not change the output, so is left out"""
+    cmd = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--workers':
+            skip = True
+        elif not arg.startswith('--workers='):
+            cmd.append(arg)
+    return " ".join(cmd)
+
+
+class SpecGenerator(object):
+    """Computes the spec entries of chunks of the mbox files; with --workers, in each worker process"""
+    def __init__(self, args):
+        if not args.nomboxo:
+            # Temporary patch to fix Python email package limitation
+            # It must be removed when the Python package is fixed
+            from mboxo_patch import MboxoFactory
+        import archiver
+        deterministic.apply()
+        cli_args = collections.namedtuple('testargs', ['parse_html'])(args.html)
+        self.args = args
+        self.archiver = archiver
+        self.archie = interfacer.Archiver(archiver, cli_args)
+        self.factory = None if args.nomboxo else MboxoFactory
+        self.mboxes = {}
+
+    def run_chunk(self, mboxfile, start, stop):
+        """Returns the entries for messages start to stop-1 of an mbox file"""
+        args = self.args
+        if mboxfile not in self.mboxes:
+            self.mboxes[mboxfile] = mbox_index.IndexedMbox(mboxfile, self.factory, args.nomboxo)
+        mbox = self.mboxes[mboxfile]
+        def read():
+            for key in range(start, stop):
+                message_raw, message = _read(args, mbox, key)
+                lid = self.archiver.normalize_lid(message.get('list-id', '??'))
+                yield lid, message, message_raw, key
         tests = []
-        mbox = mailbox.mbox(mboxfile, None if args.nomboxo else MboxoFactory, create=False)
-        for key in mbox.keys():
-            message_raw = _raw(args, mbox, key)
-            message = mbox.get(key)
-            lid = archiver.normalize_lid(message.get('list-id', '??'))
-            json = archie.compute_updates(fake_args, lid, False, message, message_raw)
+        for (lid, message, message_raw, key), json in self.archie.compute_many(fake_args, read(), chunk=GENERATE_CHUNK):
             body_sha3_256 = None
             if json and json.get('body') is not None:
                 body_sha3_256 = hashlib.sha3_256(json['body'].encode('utf-8')).hexdigest()
@@ -57,86 +100,217 @@ def generate_specs(args):
                 'body_sha3_256': body_sha3_256,
                 'attachments': json['attachments'] if json else [],
             })
-        items[mboxfile] = tests
-    with open(args.generate, 'w') as f:
-        yaml.dump({'args': {'cmd': " ".join(sys.argv), 'parse_html': True if args.html else False}, 'parsing': items}, f, sort_keys=False)
-        f.close()
-
-
-def run_tests(args):
-    if not args.nomboxo:
-        # Temporary patch to fix Python email package limitation
-        # It must be removed when the Python package is fixed
-        from mboxo_patch import MboxoFactory
-    import archiver    
-    import logging
-    verbose_logger = logging.getLogger()
-    verbose_logger.setLevel(logging.WARN)
-    verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
-    archiver.logger = verbose_logger
-    errors = 0
-    tests_run = 0
-    yml = yaml.safe_load(open(args.load, 'r'))
-    parse_html = yml.get('args', {}).get('parse_html', False)
-
-    test_args = collections.namedtuple('testargs', ['parse_html'])(parse_html)
-    archie = interfacer.Archiver(archiver, test_args)
-    _env = {}
-    if 'args' in yml and 'env' in yml['args']:
-        _env = yml['args']['env']
-
-    mboxfiles = []
-
-    for file, tests in yml['parsing'].items():
-        mboxfiles.append(file)
-        if not tests: # No tests under this filename, run same tests as next
-            continue
-        for mboxfile in mboxfiles:
-            sys.stderr.write("Starting to process %s\n" % mboxfile)
-            mbox = mailbox.mbox(mboxfile, None if args.nomboxo else MboxoFactory, create=False)
-            no_messages = len(mbox.keys())
-            no_tests = len(tests)
-            if no_messages != no_tests:
-                sys.stderr.write("Warning: %s run for parsing test of %s contains %u tests, but mbox file has %u emails!\n" %
-                                ('TBA', mboxfile, no_tests, no_messages))
+        return tests
+
+
+def generate_specs(args, argv):
+    """
+    Writes the spec as the entries are computed, in chunks of messages which are shared
+    out among the --workers; the output is the same as a yaml.dump of the whole spec
+    """
+    run = SpecGenerator(args)
+    sys.stderr.write("Generating parsing specs for file '%s'...\n" % args.mboxfile)
+    chunks = []
+    for mboxfile in args.mboxfile:
+        count = len(mbox_index.load(mboxfile)['messages'])
+        chunks.extend((mboxfile, start, min(start + GENERATE_CHUNK, count))
+                      for start in range(0, count or 1, GENERATE_CHUNK))
+    pool = shards.Pool('parsing', argv, args.workers) if args.workers > 1 else None
+    with open(args.generate + '.tmp', 'w') as f:
+        out = yaml_stream.Writer(f)
+        out.start_mapping()
+        out.value('args')
+        out.value({'cmd': _cmd(sys.argv), 'parse_html': True if args.html else False})
+        out.value('parsing')
+        out.start_mapping()
+        previous = None
+        for (mboxfile, _, _), tests in zip(chunks, shards.results(run, chunks, pool)):
+            if mboxfile != previous:
+                if previous is not None:
+                    out.end_sequence()
+                out.value(mboxfile)
+                out.start_sequence()
+                previous = mboxfile
             for test in tests:
-                tests_run += 1
-                key = test['index']
-                message_raw = _raw(args, mbox, key)
-                message = mbox.get(key)
-                msgid =(message.get('message-id') or '').strip()
-                if msgid != test['message-id']:
-                    sys.stderr.write("""[SEQ?] index %2u: Expected '%s', got '%s'!\n""" %
-                                    (key, test['message-id'], msgid))
-                    continue # no point continuing
-                lid = archiver.normalize_lid(message.get('list-id', '??'))
-                json = archie.compute_updates(fake_args, lid, False, message, message_raw)
-                body_sha3_256 = None
-                if json and json.get('body') is not None:
-                    if not json.get('html_source_only'):
-                        body_sha3_256 = hashlib.sha3_256(json['body'].encode('utf-8')).hexdigest()
-                # get override for version (if any)
-                expected = test.get(archie.version, test['body_sha3_256'])
-                if body_sha3_256 != expected:
-                    errors += 1
-                    sys.stderr.write("""[FAIL] parsing index %2u: Expected: %s Got: %s\n""" %
-                                    (key, expected, body_sha3_256))
-                att = json['attachments'] if json else []
-                att_expected = test['attachments'] or []
-                if att != att_expected:
-                    errors += 1
-                    sys.stderr.write("""[FAIL] attachments index %2u: Expected: %s Got: %s\n""" %
-                                    (key, att_expected, att))
-                else:
-                    print("[PASS] index %u" % (key))
+                out.value(test)
+        if previous is not None:
+            out.end_sequence()
+        out.end_mapping()
+        out.end_mapping()
+        out.close()
+    os.replace(args.generate + '.tmp', args.generate)
+    if pool:
+        pool.close()
+
+
+class TestRun(object):
+    """
+    The state of a run of the tests in a spec. With --workers, each worker process
+    has its own, which runs chunks of the tests for the main process to merge.
+    """
+    def __init__(self, args, worker=False):
+        if not args.nomboxo:
+            # Temporary patch to fix Python email package limitation
+            # It must be removed when the Python package is fixed
+            from mboxo_patch import MboxoFactory
+        self.imports = importprofile.from_args(args)
+        with importprofile.phase(self.imports, importprofile.IMPORT):
+            import archiver
+        deterministic.apply()
+        import logging
+        verbose_logger = logging.getLogger()
+        verbose_logger.setLevel(logging.WARN)
+        if not worker: # shards.py directs the log of workers to the output of each chunk
+            verbose_logger.addHandler(logging.StreamHandler(sys.stderr))
+        archiver.logger = verbose_logger
+        self.args = args
+        self.archiver = archiver
+        self.factory = None if args.nomboxo else MboxoFactory
+        self.errors = 0
+        self.tests_run = 0
+        self.report = results.Reporter(args, 'parsing')
+        self.compute = compute_.Compute(args, 'parsing', self.imports)
+        self.yml = spec_loader.load(args.load)
+        parse_html = self.yml.get('args', {}).get('parse_html', False)
+
+        test_args = collections.namedtuple('testargs', ['parse_html'])(parse_html)
+        self.archie = importprofile.first(self.imports, importprofile.CONSTRUCT, 'parsing',
+                                          lambda: interfacer.Archiver(archiver, test_args))
+        self.selected = shard_plan.selected(self.yml, 'parsing', args.message_range)
+        self.mboxes = {} # per mbox file, in workers
+
+    def run_test(self, mboxfile, mbox, test):
+        args = self.args
+        archie = self.archie
+        report = self.report
+        self.tests_run += 1
+        key = test['index']
+        msgid =(mbox.message_id(key) or '').strip()
+        if msgid != test['message-id']:
+            sys.stderr.write("""[SEQ?] index %2u: Expected '%s', got '%s'!\n""" %
+                            (key, test['message-id'], msgid))
+            report.test(None, mboxfile, key, msgid, 'seq')
+            return # no point continuing
+        message_raw, message = _read(args, mbox, key)
+        lid = self.archiver.normalize_lid(message.get('list-id', '??'))
+        json, elapsed = self.compute(archie, 'parsing', mboxfile, (lid,), fake_args, lid, False, message, message_raw)
+        failed = self.errors
+        body_sha3_256 = None
+        if json and json.get('body') is not None:
+            if not json.get('html_source_only'):
+                body_sha3_256 = hashlib.sha3_256(json['body'].encode('utf-8')).hexdigest()
+        # get override for version (if any)
+        expected = test.get(archie.version, test['body_sha3_256'])
+        if body_sha3_256 != expected:
+            self.errors += 1
+            sys.stderr.write("""[FAIL] parsing index %2u: Expected: %s Got: %s\n""" %
+                            (key, expected, body_sha3_256))
+        att = json['attachments'] if json else []
+        att_expected = test['attachments'] or []
+        if att != att_expected:
+            self.errors += 1
+            sys.stderr.write("""[FAIL] attachments index %2u: Expected: %s Got: %s\n""" %
+                            (key, att_expected, att))
+            report.test(None, mboxfile, key, msgid, 'fail', elapsed, version=archie.version,
+                        memory=self.compute.memory)
+        elif self.errors != failed: # only the body differs; the text output has always said PASS here
+            report.test(None, mboxfile, key, msgid, 'fail', elapsed, "[PASS] index %u" % (key), archie.version,
+                        self.compute.memory)
+        else:
+            report.test(None, mboxfile, key, msgid, 'pass', elapsed, "[PASS] index %u" % (key), archie.version,
+                        self.compute.memory)
+
+    def sections(self):
+        """Yields (mbox file, yaml key of its tests) in the order they are run"""
         mboxfiles = []
-    # N.B. The following line is parsed by runall.py
-    print("[DONE] %u tests run, %u failed." % (tests_run, errors))
+        for file, tests in self.yml['parsing'].items():
+            mboxfiles.append(file)
+            if not tests: # No tests under this filename, run same tests as next
+                continue
+            for mboxfile in mboxfiles:
+                yield mboxfile, file
+            mboxfiles = []
+
+    def tests(self, file, mboxfile):
+        """The tests for an mbox file, less any outside --message-range"""
+        tests = self.yml['parsing'][file]
+        if self.selected is None:
+            return tests
+        return [test for test in tests if (mboxfile, test['index']) in self.selected]
+
+    def run_chunk(self, mboxfile, file, start, stop):
+        """Runs tests start to stop of a section in a worker; returns the counts"""
+        if mboxfile not in self.mboxes:
+            self.mboxes[mboxfile] = mbox_index.IndexedMbox(mboxfile, self.factory, self.args.nomboxo)
+        self.tests_run = self.errors = 0
+        cache = self.compute.cache
+        hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+        for test in self.tests(file, mboxfile)[start:stop]:
+            self.run_test(mboxfile, self.mboxes[mboxfile], test)
+        if cache:
+            hits, misses = cache.hits - hits, cache.misses - misses
+        return self.tests_run, self.errors, hits, misses
+
+    def merge(self, out, err, result):
+        """Adds the output and counts of a chunk run by a worker"""
+        sys.stdout.write(out)
+        sys.stdout.flush()
+        sys.stderr.write(err)
+        tests_run, errors, hits, misses = result
+        self.tests_run += tests_run
+        self.errors += errors
+        if self.compute.cache:
+            self.compute.cache.hits += hits
+            self.compute.cache.misses += misses
+
+
+def run_tests(args, argv):
+    run = TestRun(args)
+    pool = None
+    sections = list(run.sections())
+    futures = []
+    if args.workers > 1:
+        pool = shards.Pool('parsing', argv, args.workers)
+        # Start every chunk now, the output is merged section by section below
+        for mboxfile, file in sections:
+            futures.append([pool.submit((mboxfile, file, start, stop))
+                            for start, stop in shards.split(len(run.tests(file, mboxfile)), args.workers)])
+    for i, (mboxfile, file) in enumerate(sections):
+        tests = run.yml['parsing'][file]
+        sys.stderr.write("Starting to process %s\n" % mboxfile)
+        mbox = mbox_index.IndexedMbox(mboxfile, run.factory, args.nomboxo)
+        no_messages = len(mbox)
+        no_tests = len(tests)
+        if no_messages != no_tests:
+            sys.stderr.write("Warning: %s run for parsing test of %s contains %u tests, but mbox file has %u emails!\n" %
+                            ('TBA', mboxfile, no_tests, no_messages))
+        if pool:
+            for future in futures[i]:
+                run.merge(*future.result())
+        else:
+            for test in run.tests(file, mboxfile):
+                run.run_test(mboxfile, mbox, test)
+    if pool:
+        pool.close()
+    run.compute.close()
+    tests_run = run.tests_run
+    errors = run.errors
+    run.report.done(tests_run, errors, 0, "[DONE] %u tests run, %u failed." % (tests_run, errors), run.compute.maxrss,
+                    run.compute.imports)
     if errors:
         sys.exit(-1)
 
 
-def main():
+def worker_run(argv):
+    """The TestRun or SpecGenerator for a --workers process (see shards.py)"""
+    args = parse_args(argv)
+    setup(args)
+    if args.generate:
+        return SpecGenerator(args)
+    return TestRun(args, worker=True)
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Command line options.')
     parser.add_argument('--generate', dest='generate', type=str,
                         help='Generate a test yaml spec, output to file specified here')
@@ -150,21 +324,39 @@ def main():
                         help="Enable HTML parsing if generating test specs")
     parser.add_argument('--nomboxo', dest = 'nomboxo', action='store_true',
                         help = 'Skip Mboxo processing')
-    args = parser.parse_args()
+    parser.add_argument('--jsonl', dest = 'jsonl', action='store_true',
+                        help = 'Write a JSON record per test to stdout instead of text (used by runall.py)')
+    compute_.add_arguments(parser)
+    shards.add_arguments(parser)
+    shard_plan.add_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.workers > 1 and (args.bench or args.profile or args.profile_dir or args.memprofile or args.importprofile):
+        parser.error('--workers cannot be combined with --bench, --profile, --memprofile or --importprofile')
+    return args
+
 
+def setup(args):
+    """Makes the Pony Mail tools importable"""
     if args.rootdir:
         tools_dir = os.path.join(args.rootdir, 'tools')
     else:
         tools_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', "tools")
-    sys.path.append(tools_dir)
+    if tools_dir not in sys.path:
+        sys.path.append(tools_dir)
+
 
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    setup(args)
     if args.generate:
         if not args.mboxfile:
             sys.stderr.write("Generating a test spec requires an mbox filepath passed with --mbox!\n")
             sys.exit(-1)
-        generate_specs(args)
+        generate_specs(args, argv)
     elif args.load:
-        run_tests(args)
+        run_tests(args, argv)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Opt-in on-disk cache of compute_updates results, for quick re-runs.
+
+Each result is stored in its own file, named by a SHA-256 over everything
+the result can depend on:
+- the raw message bytes, the List-ID used and any archived-at override
+- the generator, parse_html and detected Pony Mail version
+- MOCK_GMTIME, PYTHONHASHSEED and --nomboxo
+- every .py file under <rootdir>/tools, plus the interfacer
+so any change to the archiver or generators invalidates all entries.
+
+Only the fields used by the tests (mid, body, attachments, html_source_only)
+are kept. The cache is limited in size: hits refresh the file mtime, and when
+the cache is closed the least recently used files are removed until it is
+below the limit.
+
+Enabled with --cache DIR (or the PONYMAIL_TEST_CACHE environment variable);
+--no-cache disables it regardless.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+MISS = object()
+FIELDS = ('mid', 'body', 'attachments', 'html_source_only')
+DEFAULT_SIZE_MB = 512
+
+
+def add_arguments(parser):
+    """Adds the cache options to a test script or runall.py argument parser"""
+    parser.add_argument('--cache', dest='cache', type=str, default=os.environ.get('PONYMAIL_TEST_CACHE'),
+                        help='Cache compute_updates results in this directory (default $PONYMAIL_TEST_CACHE)')
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=DEFAULT_SIZE_MB,
+                        help='Maximum size of the result cache in MB (default %u)' % DEFAULT_SIZE_MB)
+    parser.add_argument('--no-cache', dest='nocache', action='store_true',
+                        help='Do not use the result cache, even if one is configured')
+
+
+def source_hash(rootdir):
+    """Hash of all Python sources which can affect the results"""
+    sha = hashlib.sha256()
+    paths = [os.path.join(os.path.dirname(os.path.realpath(__file__)), 'interfacer.py')]
+    for dirpath, dirnames, filenames in os.walk(os.path.join(rootdir, 'tools')):
+        dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames) if f.endswith('.py'))
+    for path in paths:
+        sha.update(path.encode('utf-8', 'surrogateescape'))
+        with open(path, 'rb') as f:
+            sha.update(hashlib.sha256(f.read()).digest())
+    return sha.hexdigest()
+
+
+class UpdateCache(object):
+    def __init__(self, directory, rootdir, max_mb=DEFAULT_SIZE_MB, nomboxo=False):
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024
+        os.makedirs(directory, exist_ok=True)
+        self.context = repr((source_hash(rootdir), os.environ.get('MOCK_GMTIME'),
+                             os.environ.get('PYTHONHASHSEED'), bool(nomboxo))).encode('utf-8')
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, archie, message_raw, *extra):
+        sha = hashlib.sha256(self.context)
+        sha.update(repr((archie.generator, archie.parse_html, archie.version) + extra).encode('utf-8', 'surrogateescape'))
+        sha.update(message_raw)
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key):
+        """Returns the cached result, or MISS"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            os.utime(path) # most recently used
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return MISS
+        self.hits += 1
+        return result
+
+    def put(self, key, json):
+        result = None if json is None else {k: json[k] for k in FIELDS if k in json}
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def close(self):
+        """Applies the size limit, removing the least recently used entries"""
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue # removed by another process
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def from_args(args, rootdir):
+    """Returns the cache selected by the command line options, or None"""
+    if args.cache and not args.nocache:
+        return UpdateCache(args.cache, rootdir, args.cache_size, args.nomboxo)
+    return None
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Watch mode for runall.py: after the first run, waits for changes to the Pony
+Mail sources or the specs and re-runs the tests they may affect.
+
+The tests run in the runall process (as with --inprocess), so the archiver's
+dependencies, the parsed specs (spec_loader) and the corpus indexes
+(mbox_index) stay loaded between runs. When a module imported by archiver.py
+changes, the modules loaded from --rootdir/tools are dropped from sys.modules
+and archiver.py is imported again, which only re-executes the Pony Mail
+sources. What to re-run is worked out as for --changed-since (changes.py),
+comparing with the sources of the previous run, so an edit to one generator
+function only re-runs that generator's tests. A changed spec is re-run in full.
+
+Specs which need a PYTHONHASHSEED other than runall's own are still run in a
+subprocess, so start runall with PYTHONHASHSEED=0 (as most specs use) for the
+quickest turnaround.
+
+To use:
+
+watch.add_arguments(parser)
+...
+watch.loop(args, spec_files, run) # calls run(args, spec_files, progress) for each change
+"""
+
+import copy
+import importlib.util
+import os
+import sys
+import time
+import traceback
+
+import changes
+import deterministic
+import inprocess
+
+DEFAULT_INTERVAL = 0.5
+
+
+def add_arguments(parser):
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help="After running the tests, keep the archiver loaded and re-run the tests affected by "
+                             "each change to the Pony Mail sources or the specs, until interrupted")
+    parser.add_argument('--watch-interval', dest='watch_interval', type=float, default=DEFAULT_INTERVAL,
+                        help="Seconds between checks for changes with --watch (default %g)" % DEFAULT_INTERVAL)
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class Watcher(object):
+    """Notices changes to the archiver modules under rootdir/tools and to the spec files"""
+    def __init__(self, rootdir, spec_files):
+        self.tools_dir = os.path.realpath(os.path.join(rootdir, 'tools'))
+        self.spec_files = spec_files
+        self.sources = {} # archiver module -> contents as last run
+        self.stats = {spec_file: _stat(spec_file) for spec_file in spec_files}
+        self._snapshot(changes.archiver_modules(self.tools_dir))
+
+    def _snapshot(self, paths):
+        self.sources = {path: _read(path) for path in paths}
+        for path in paths:
+            self.stats[path] = _stat(path)
+
+    def poll(self):
+        """
+        Returns (changed sources, test types, generators, changed specs) since the last call.
+        The test types and generators affected by the changed sources are as for changes.affected.
+        """
+        specs = [spec_file for spec_file in self.spec_files if _stat(spec_file) != self.stats[spec_file]]
+        for spec_file in specs:
+            self.stats[spec_file] = _stat(spec_file)
+        if all(_stat(path) == self.stats[path] for path in self.sources):
+            return [], [], [], specs
+        old_sources = self.sources
+        try:
+            paths = changes.archiver_modules(self.tools_dir) # the imports may have changed too
+        except SyntaxError:
+            paths = set(old_sources)
+        self._snapshot(paths)
+        changed = sorted(path for path in set(old_sources) | set(self.sources)
+                         if old_sources.get(path) != self.sources.get(path))
+        if not changed:
+            return [], [], [], specs # touched but unchanged
+        if any(self.sources.get(path) is None for path in changed):
+            return changed, None, None, specs # removed
+        try:
+            ttypes, gtypes = changes.affected(self.tools_dir, changed, old_sources.get)
+        except SyntaxError:
+            ttypes, gtypes = None, None # will be reported when the archiver is imported
+        return changed, ttypes, gtypes, specs
+
+
+def reload(rootdir, changed):
+    """Drops the modules loaded from rootdir/tools and imports archiver.py again"""
+    tools_dir = os.path.realpath(os.path.join(rootdir, 'tools'))
+    deterministic.restore()
+    for path in changed:
+        # The bytecode is only checked against the size and mtime in seconds of the source
+        try:
+            os.remove(importlib.util.cache_from_source(path))
+        except OSError:
+            pass
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, '__file__', None)
+        if filename and os.path.realpath(filename).startswith(tools_dir + os.sep):
+            del sys.modules[name]
+    importlib.invalidate_caches()
+    inprocess.init_worker(rootdir)
+
+
+class FirstResult(object):
+    """Stands in for runall's progress display to note when the first test result arrives"""
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.time = None
+
+    def update(self, record):
+        if self.time is None:
+            self.time = time.perf_counter()
+        if self.progress:
+            self.progress.update(record)
+
+
+def _names(values):
+    return 'all' if values is None else ', '.join(values) or 'none'
+
+
+def _rerun(args, spec_files, run, progress):
+    started = time.perf_counter()
+    first = FirstResult(progress)
+    failed = run(args, spec_files, first)
+    print("Re-ran in %.2f s, first result after %s" %
+          (time.perf_counter() - started, 'n/a' if first.time is None else '%.2f s' % (first.time - started)))
+    return failed
+
+
+def loop(args, spec_files, run, progress=None):
+    """
+    Waits for changes, calling run(args, spec_files, progress) with the specs, and
+    args.ttype and args.gtype narrowed to the tests each change may affect.
+    Returns whether the last run failed (None if there was none) when interrupted.
+    """
+    watcher = Watcher(args.rootdir, spec_files)
+    failed = None
+    broken = False # the archiver failed to import, so the changes since the last run add up
+    print("Watching %u Pony Mail sources and %u specs for changes (Ctrl-C to stop)" %
+          (len(watcher.sources), len(spec_files)), file=sys.stderr, flush=True)
+    try:
+        while True:
+            time.sleep(args.watch_interval)
+            sources, ttypes, gtypes, specs = watcher.poll()
+            if sources and broken:
+                ttypes, gtypes = None, None
+            if sources:
+                print("Changed: %s; affects test types: %s, generators: %s" %
+                      (', '.join(os.path.relpath(path, watcher.tools_dir) for path in sources),
+                       _names(ttypes), _names(gtypes)), file=sys.stderr, flush=True)
+                try:
+                    reload(args.rootdir, sources)
+                except Exception: # pylint: disable=broad-except
+                    traceback.print_exc()
+                    print("Cannot import the archiver; waiting for the next change", file=sys.stderr, flush=True)
+                    broken = True
+                    continue
+                broken = False
+                if ttypes != []:
+                    narrowed = copy.copy(args)
+                    if ttypes is not None:
+                        narrowed.ttype = [t for t in ttypes if not args.ttype or t in args.ttype]
+                    if gtypes is not None:
+                        narrowed.gtype = [g for g in gtypes if not args.gtype or g in args.gtype]
+                    failed = _rerun(narrowed, spec_files, run, progress)
+            if specs:
+                print("Changed: %s" % ', '.join(specs), file=sys.stderr, flush=True)
+                failed = _rerun(args, specs, run, progress)
+    except KeyboardInterrupt:
+        pass
+    return failed
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Writes a yaml document piece by piece, giving exactly the same text as a single
+yaml.dump(document, stream, sort_keys=False) of the whole document would, and
+reads the entries of a yaml document one at a time.
+
+The document's mappings and sequences are opened and closed explicitly, and
+everything else (keys and entries) is written as a value, which is represented
+and serialized on its own and then dropped. This keeps the memory used by a
+large spec down to one entry at a time. As a consequence, objects shared
+between separately written values are repeated rather than given aliases,
+which yaml.dump would only do for objects referenced more than once.
+
+To use:
+
+out = yaml_stream.Writer(f)
+out.start_mapping()
+out.value('key')
+out.start_sequence()
+for entry in entries:
+    out.value(entry)
+out.end_sequence()
+out.end_mapping()
+out.close()
+
+for keys, entry in yaml_stream.entries(f):
+    # e.g. keys == ('generators', mbox, gen_type) and entry == {'index': 0, ...}
+
+entries() parses the document as a series of events and only constructs one
+entry (an item of a sequence) at a time, so the memory used does not depend on
+the size of the document. It uses the libyaml C parser if available. Aliases
+are not supported; the specs do not use them.
+"""
+
+import yaml
+
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class Writer(object):
+    def __init__(self, stream):
+        self.dumper = yaml.Dumper(stream, default_flow_style=False, sort_keys=False)
+        self.dumper.open()
+        self.dumper.emit(yaml.DocumentStartEvent(explicit=None))
+
+    def start_mapping(self):
+        self.dumper.emit(yaml.MappingStartEvent(None, yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, True,
+                                                flow_style=False))
+
+    def end_mapping(self):
+        self.dumper.emit(yaml.MappingEndEvent())
+
+    def start_sequence(self):
+        self.dumper.emit(yaml.SequenceStartEvent(None, yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, True,
+                                                 flow_style=False))
+
+    def end_sequence(self):
+        self.dumper.emit(yaml.SequenceEndEvent())
+
+    def value(self, data):
+        """Writes a key or an entry of the current mapping or sequence"""
+        dumper = self.dumper
+        node = dumper.represent_data(data)
+        dumper.anchor_node(node)
+        dumper.serialize_node(node, None, None)
+        # As Dumper.represent() and Serializer.serialize() do after each document
+        dumper.represented_objects = {}
+        dumper.object_keeper = []
+        dumper.alias_key = None
+        dumper.serialized_nodes = {}
+        dumper.anchors = {}
+        dumper.last_anchor_id = 0
+
+    def close(self):
+        self.dumper.emit(yaml.DocumentEndEvent(explicit=None))
+        self.dumper.close()
+        self.dumper.dispose()
+
+
+def _value(loader, event):
+    """Constructs the value which starts with event from the following events"""
+    if isinstance(event, yaml.ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            value = event.value
+            if not event.implicit[0] or (value and value[0] not in loader.yaml_implicit_resolvers
+                                         and None not in loader.yaml_implicit_resolvers):
+                return value # quoted, or plain and can only be a string: as resolve() and construct_yaml_str()
+            tag = loader.resolve(yaml.ScalarNode, value, event.implicit)
+        # As construct_object, but without keeping every object constructed
+        constructor = loader.yaml_constructors.get(tag, loader.yaml_constructors[None])
+        return constructor(loader, yaml.ScalarNode(tag, event.value, event.start_mark, event.end_mark, event.style))
+    if isinstance(event, yaml.SequenceStartEvent):
+        data = []
+        event = loader.get_event()
+        while not isinstance(event, yaml.SequenceEndEvent):
+            data.append(_value(loader, event))
+            event = loader.get_event()
+        return data
+    if isinstance(event, yaml.MappingStartEvent):
+        data = {}
+        event = loader.get_event()
+        while not isinstance(event, yaml.MappingEndEvent):
+            data[_value(loader, event)] = _value(loader, loader.get_event())
+            event = loader.get_event()
+        return data
+    raise yaml.YAMLError("unsupported yaml event %s" % event)
+
+
+def _entries(loader, keys):
+    event = loader.get_event()
+    if isinstance(event, yaml.MappingStartEvent):
+        event = loader.get_event()
+        while not isinstance(event, yaml.MappingEndEvent):
+            yield from _entries(loader, keys + (_value(loader, event),))
+            event = loader.get_event()
+    elif isinstance(event, yaml.SequenceStartEvent):
+        event = loader.get_event()
+        while not isinstance(event, yaml.SequenceEndEvent):
+            yield keys, _value(loader, event)
+            event = loader.get_event()
+    else:
+        _value(loader, event) # a scalar outside a sequence
+
+
+def entries(stream):
+    """Yields (keys, entry) for each entry of each sequence in the document, where keys lead to the sequence"""
+    loader = Loader(stream)
+    try:
+        loader.get_event() # StreamStart
+        while loader.check_event(yaml.DocumentStartEvent):
+            loader.get_event()
+            yield from _entries(loader, ())
+            loader.get_event() # DocumentEnd
+    finally:
+        loader.dispose()
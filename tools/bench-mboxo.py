@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark for reading raw messages from mbox files with mboxo unmangling.
+
+Compares the chunked MboxoReader (formerly used by the test scripts' _raw) and a
+full MboxoFactory parse against the memory-mapped MboxoMmapReader used by
+mbox_index.IndexedMbox. Also checks that both readers return the same bytes.
+
+Reports the best throughput over --repeat passes, and the peak memory traced
+by tracemalloc during a separate pass (so tracing does not skew the timings).
+The mbox index is loaded before timing starts, whereas the MboxoReader and
+MboxoFactory timings include mailbox's own scan for message boundaries.
+
+Usage: tools/bench-mboxo.py [--repeat N] [mbox ...]
+Defaults to the three largest files in corpus/
+"""
+
+import argparse
+import glob
+import mailbox
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests'))
+from mboxo_patch import MboxoReader, MboxoFactory # pylint: disable=wrong-import-position
+import mbox_index # pylint: disable=wrong-import-position
+
+
+def read_mboxo_reader(path):
+    mbox = mailbox.mbox(path, None, create=False)
+    for key in mbox.keys():
+        file = MboxoReader(mbox.get_file(key, True))
+        yield file.read()
+        file.close()
+    mbox.close()
+
+
+def read_mboxo_factory(path):
+    mbox = mailbox.mbox(path, MboxoFactory, create=False)
+    for key in mbox.keys():
+        yield mbox.get(key)
+    mbox.close()
+
+
+def read_mmap(path):
+    mbox = mbox_index.IndexedMbox(path)
+    for key in mbox.keys():
+        yield mbox.get_bytes(key, True)
+    mbox.close()
+
+
+METHODS = (
+    ('MboxoReader', read_mboxo_reader),
+    ('MboxoFactory (parsed)', read_mboxo_factory),
+    ('MboxoMmapReader', read_mmap),
+)
+
+
+def timed(method, path, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in method(path):
+            pass
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_memory(method, path):
+    tracemalloc.start()
+    for _ in method(path):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Command line options.')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                        help="Number of timed passes over each file (best is reported)")
+    parser.add_argument('mboxfiles', nargs='*',
+                        help="mbox files to read (default: the three largest corpus files)")
+    args = parser.parse_args()
+
+    mboxfiles = args.mboxfiles
+    if not mboxfiles:
+        corpus = glob.glob(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'corpus', '*.mbox'))
+        mboxfiles = sorted(corpus, key=os.path.getsize, reverse=True)[:3]
+
+    for path in mboxfiles:
+        mbox_index.load(path) # not part of the timings
+        if list(read_mboxo_reader(path)) != list(read_mmap(path)):
+            print("ERROR: readers differ for %s" % path)
+            sys.exit(-1)
+        size = os.path.getsize(path) / (1024 * 1024)
+        print("%s (%.2f MB, %u messages)" % (os.path.basename(path), size, len(mbox_index.load(path)['messages'])))
+        for name, method in METHODS:
+            elapsed = timed(method, path, args.repeat)
+            peak = peak_memory(method, path)
+            print("  %-22s %8.2f ms %8.1f MB/s   peak %8.1f KB" % (name, elapsed * 1000, size / elapsed, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the MOCK_GMTIME clock of the test scripts.
+
+Compares calls to time.gmtime() from the archiver's generators module, and
+compute_updates over an mbox for each generator, with:
+- the real clock
+- a stack-inspecting time.gmtime replacement, as the test scripts used to install
+  (every call extracts the stack to see whether it comes from the archiver)
+- the frozen clock of tests/deterministic.py, injected into the module namespaces
+Also checks that both mocks give the same results.
+
+Usage: tools/bench-mock-time.py --rootdir PONYMAIL [--calls N] [--repeat N] [mbox]
+Defaults to corpus/maven-dev-2017-11-listsao.mbox, which is tested with MOCK_GMTIME
+"""
+
+import argparse
+import collections
+import os
+import sys
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests'))
+from mboxo_patch import MboxoFactory # pylint: disable=wrong-import-position
+import mbox_index # pylint: disable=wrong-import-position
+import interfacer # pylint: disable=wrong-import-position
+import deterministic # pylint: disable=wrong-import-position
+
+fake_args = collections.namedtuple('fakeargs', ['verbose', 'ibody'])(False, None)
+
+
+def stack_inspecting_clock():
+    """Replaces time.gmtime globally as the test scripts used to; returns a function to undo it"""
+    save_gmtime = time.gmtime
+    def _time_gmtime(secs=None):
+        if secs is None:
+            callers = traceback.extract_stack(limit=2) # want last-1 and last (i.e. here)
+            [filename, _, _, _] = callers[0] # This is last-1, i.e. my caller
+            if filename.endswith("/tools/archiver.py") or filename.endswith("tools/generators.py"):
+                return save_gmtime(0)
+        return save_gmtime(secs)
+    time.gmtime = _time_gmtime
+    def undo():
+        time.gmtime = save_gmtime
+    return undo
+
+
+def frozen_clock():
+    deterministic.freeze_clock(0)
+    return deterministic.restore
+
+
+def real_clock():
+    return lambda: None
+
+
+CLOCKS = [('real', real_clock), ('stack-inspecting', stack_inspecting_clock), ('frozen', frozen_clock)]
+
+
+def probe(generators):
+    """A function calling time.gmtime() as code in the generators module does"""
+    namespace = {}
+    code = compile("def calls(n):\n    for _ in range(n):\n        year = time.gmtime().tm_year\n    return year\n",
+                   generators.__file__, 'exec')
+    exec(code, generators.__dict__, namespace) # pylint: disable=exec-used
+    return namespace['calls']
+
+
+def best(repeat, fn):
+    """Returns (best time, result) of repeat calls"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - started)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MOCK_GMTIME clock.')
+    parser.add_argument('--rootdir', dest='rootdir', type=str, required=True,
+                        help="Root directory of Apache Pony Mail")
+    parser.add_argument('--calls', dest='calls', type=int, default=100000,
+                        help="Number of time.gmtime() calls to time (default 100000)")
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+                        help="Number of passes to take the best of (default 3)")
+    parser.add_argument('mbox', nargs='?', default='corpus/maven-dev-2017-11-listsao.mbox')
+    args = parser.parse_args()
+
+    sys.path.append(os.path.join(args.rootdir, 'tools'))
+    import archiver # pylint: disable=import-outside-toplevel
+    try:
+        import generators # pylint: disable=import-outside-toplevel
+    except ImportError:
+        import plugins.generators as generators # pylint: disable=import-outside-toplevel
+    generator_names = generators.generator_names() if hasattr(generators, 'generator_names') else ['full', 'medium', 'cluster', 'legacy']
+
+    calls = probe(generators)
+    print("time.gmtime() from %s:" % generators.__file__)
+    print("%18s %12s %6s" % ('clock', 'ns/call', 'year'))
+    for name, install in CLOCKS:
+        undo = install()
+        try:
+            elapsed, year = best(args.repeat, lambda: calls(args.calls))
+        finally:
+            undo()
+        print("%18s %12.0f %6u" % (name, elapsed / args.calls * 1e9, year))
+
+    mbox = mbox_index.IndexedMbox(args.mbox, MboxoFactory)
+    messages = []
+    for key in mbox.keys():
+        message = mbox.get(key)
+        messages.append((archiver.normalize_lid(message.get('list-id', '??')), message, mbox.get_bytes(key, True)))
+    print()
+    print("compute_updates for %u messages of %s, messages/second:" % (len(messages), args.mbox))
+    print("%10s" % 'generator' + ''.join("%18s" % name for name, _ in CLOCKS))
+    mismatches = 0
+    for gen_type in generator_names:
+        test_args = collections.namedtuple('testargs', ['parse_html', 'generator'])(False, gen_type)
+        archie = interfacer.Archiver(archiver, test_args)
+        rates = []
+        mocked = []
+        for name, install in CLOCKS:
+            undo = install()
+            try:
+                elapsed, ids = best(args.repeat, lambda: [json and json['mid'] for _, json in
+                                                          archie.compute_many(fake_args, messages, chunk=100)])
+            finally:
+                undo()
+            rates.append(len(messages) / elapsed if elapsed else 0)
+            if name != 'real':
+                mocked.append(ids)
+        if mocked[0] != mocked[1]:
+            mismatches += 1
+        print("%10s" % gen_type + ''.join("%18.0f" % rate for rate in rates))
+    if mismatches:
+        print("ERROR: the frozen and stack-inspecting clocks gave different IDs for %u generator%s" %
+              (mismatches, 's' if mismatches != 1 else ''))
+        sys.exit(-1)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,73 +13,211 @@ However duplicates can occur in archive files if:
 Used for multi-import tests where you wish to check that multiple sources give the same ID
 
 Emails with duplicate sort keys are logged and dropped
+
+With --stream, only the sort key and position of each message are kept in memory, and
+only up to --memory-limit MB of those before they are sorted and spilled to a temporary
+file; the sorted runs are then merged and the messages copied from the input files.
+This gives the same output for archives of any size. Duplicates are logged in sort order
+rather than in input order.
+
+Input files may be compressed (.gz, .xz, .zst; see tests/compressed.py).
 """
 
 import argparse
-import mailbox
+import email.parser
+import heapq
+import os
+import pickle
 import re
 import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests'))
+import compressed # pylint: disable=wrong-import-position
+
+SPILL_BATCH = 10000 # records per pickle in a spill file
+
+
+def sort_key(from_, message):
+    """Returns (sort key, True if the message-id is missing), or (None, False) if the ezmlm id is missing"""
+    if args.ezmlm:
+        m = re.search(r"return-(\d+)-", from_)
+        if m:
+            return m.group(1), False
+        print("Failed to find ezmlm id in %s" % from_)
+        return None, False
+    msgid = message.get('message-id')
+    if msgid:
+        return msgid.strip(), False
+    print("No message id, sorting by date or subject: ", from_)
+    altid = message.get('date') or message.get('subject')
+    return "~" + altid.strip(), True # try to ensure it sorts last
+
+
+def collate(msgfiles):
+    """Reads all the messages into memory; returns the sorted (sort key, raw message) pairs"""
+    global noid, skipped, crlf
+    allmessages = {}
+    for msgfile in msgfiles:
+        messages = compressed.open_mbox(msgfile)
+        for key in messages.iterkeys():
+            message = messages.get(key)
+            sortkey, missing = sort_key(message.get_from(), message)
+            if sortkey is None:
+                skipped += 1
+                continue
+            noid += missing
+            # store the data
+            file = messages.get_file(key, True)
+            message_raw = b''
+            if crlf is None:
+                message_raw = file.readline()
+                crlf = (message_raw.endswith(b'\r\n'))
+            message_raw += file.read()
+            file.close()
+            if sortkey in allmessages:
+                print("Duplicate sort key: %s" % sortkey)
+                skipped += 1
+            allmessages[sortkey] = message_raw
+    return [(key, allmessages[key]) for key in sorted(allmessages.keys())]
+
+
+def scan(f):
+    """
+    Yields (start, stop, From_ line, header bytes) for each message in an mbox file,
+    finding the message boundaries in the same way as mailbox.mbox
+    """
+    linesep = os.linesep.encode('ascii')
+    start = None
+    from_line = None
+    header = []
+    in_header = False # until the first blank line
+    last_was_empty = False
+    while True:
+        line_pos = f.tell()
+        line = f.readline()
+        if line.startswith(b'From ') or not line:
+            if start is not None:
+                stop = line_pos - len(linesep) if last_was_empty else line_pos
+                yield start, stop, from_line, b''.join(header)
+            if not line:
+                break
+            start, from_line, header, in_header = line_pos, line, [], True
+            last_was_empty = False
+            continue
+        last_was_empty = line == linesep
+        if in_header:
+            if line in (b'\n', b'\r\n'):
+                in_header = False
+            else:
+                header.append(line)
+
+
+def spill(records):
+    """Sorts records and writes them to a temporary file; returns an iterator reading them back"""
+    f = tempfile.TemporaryFile()
+    records.sort()
+    for i in range(0, len(records), SPILL_BATCH):
+        pickle.dump(records[i:i + SPILL_BATCH], f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    def read():
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                f.close()
+                return
+            yield from batch
+    return read()
+
+
+def collate_stream(msgfiles, memory_limit):
+    """Yields the sorted (sort key, input file, start, stop) of the messages to write"""
+    global noid, skipped, crlf
+    parser = email.parser.BytesParser()
+    runs = []
+    records = []
+    size = 0
+    seq = 0
+    for fileno, msgfile in enumerate(msgfiles):
+        with compressed.open(msgfile) as f:
+            for start, stop, from_line, header in scan(f):
+                message = parser.parsebytes(header, headersonly=True)
+                sortkey, missing = sort_key(from_line.replace(b'\n', b'')[5:].decode('ascii', 'replace'), message)
+                if sortkey is None:
+                    skipped += 1
+                    continue
+                noid += missing
+                if crlf is None:
+                    crlf = from_line.endswith(b'\r\n')
+                # seq breaks ties so the last message with a duplicate key is kept, as above
+                records.append((sortkey, seq, fileno, start, stop))
+                seq += 1
+                size += len(sortkey) + 100
+                if size > memory_limit:
+                    runs.append(spill(records))
+                    records = []
+                    size = 0
+    records.sort()
+    runs.append(iter(records))
+    previous = None
+    for record in heapq.merge(*runs):
+        if previous is not None:
+            if record[0] == previous[0]:
+                print("Duplicate sort key: %s" % record[0])
+                skipped += 1
+            else:
+                yield previous[0], previous[2], previous[3], previous[4]
+        previous = record
+    if previous is not None:
+        yield previous[0], previous[2], previous[3], previous[4]
+
 
 parser = argparse.ArgumentParser(description='Command line options.')
 parser.add_argument('--ezmlm', dest='ezmlm', action='store_true',
                     help="Use ezmlm numbering for sorting")
+parser.add_argument('--stream', dest='stream', action='store_true',
+                    help="Copy messages from the input files in sorted order instead of holding them all in memory")
+parser.add_argument('--memory-limit', dest='memory_limit', type=int, default=256,
+                    help="With --stream, sort keys to hold in memory before spilling to disk, in MB (default 256)")
 parser.add_argument('args', nargs=argparse.REMAINDER)
 args = parser.parse_args()
 
 outmbox = args.args[0]
 msgfiles = args.args[1:] # multiple input files allowed
 
-allmessages = {}
 noid = 0
 skipped = 0
 crlf = None # assume that all emails have the same EOL
-for msgfile in msgfiles:
-    messages = mailbox.mbox(
-        msgfile, None, create=False
-    )
-    sortkey = None
-    for key in messages.iterkeys():
-        message = messages.get(key)
-        if args.ezmlm:
-            from_ = message.get_from()
-            m = re.search(r"return-(\d+)-", from_)
-            if m:
-                sortkey = m.group(1)
-            else:
-                print("Failed to find ezmlm id in %s" % from_)
-                skipped += 1
-                continue
-        else:
-            msgid = message.get('message-id')
-            if msgid:
-                sortkey = msgid.strip()
-            else:
-                print("No message id, sorting by date or subject: ", message.get_from())
-                noid += 1
-                altid = message.get('date') or message.get('subject')
-                sortkey = "~" + altid.strip() # try to ensure it sorts last
-        # store the data
-        file = messages.get_file(key, True)
-        message_raw = b''
-        if crlf is None:
-            message_raw = file.readline()
-            crlf = (message_raw.endswith(b'\r\n'))
-        message_raw += file.read()
-        file.close()
-        if sortkey in allmessages:
-            print("Duplicate sort key: %s" % sortkey)
-            skipped += 1
-        allmessages[sortkey] = message_raw
-
 
 nw = 0
 with open(outmbox, "wb") as f:
-    for key in sorted(allmessages.keys()):
-        f.write(allmessages[key])
-        if crlf:
-            f.write(b'\r\n')
-        else:
-            f.write(b'\n')
-        nw += 1
+    if args.stream:
+        infiles = [compressed.open(msgfile) for msgfile in msgfiles]
+        for _, fileno, start, stop in collate_stream(msgfiles, args.memory_limit * 1024 * 1024):
+            infile = infiles[fileno]
+            infile.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = infile.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+            if crlf:
+                f.write(b'\r\n')
+            else:
+                f.write(b'\n')
+            nw += 1
+        for infile in infiles:
+            infile.close()
+    else:
+        for _, message_raw in collate(msgfiles):
+            f.write(message_raw)
+            if crlf:
+                f.write(b'\r\n')
+            else:
+                f.write(b'\n')
+            nw += 1
 
 print("Wrote %u emails to %s with CRLF %s (%u without message-id) WARN: %u skipped" % (nw, outmbox, crlf, noid, skipped))
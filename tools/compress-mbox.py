@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Compresses an mbox file for random access by the test scripts (see tests/compressed.py).
+
+The output is written as a series of independently compressed frames (gzip
+members, xz streams or zstd frames, by the suffix of outfile) of about
+--block-size MB of the mbox each, each starting at a 'From ' line. Any
+gzip, xz or zstd tool can decompress the result as usual. The output only
+depends on the input and the options.
+
+Usage: tools/compress-mbox.py [--block-size MB] mbox outfile
+
+e.g. tools/compress-mbox.py corpus/big.mbox corpus/big.mbox.xz
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests'))
+import compressed # pylint: disable=wrong-import-position
+
+
+def frames(f, block_size):
+    """Yields the contents of f in pieces of at least block_size bytes, split before 'From ' lines"""
+    lines = []
+    size = 0
+    for line in f:
+        if size >= block_size and line.startswith(b'From '):
+            yield b''.join(lines)
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line)
+    if lines:
+        yield b''.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compress an mbox file for random access.')
+    parser.add_argument('mbox', type=str, help='mbox file to compress')
+    parser.add_argument('outfile', type=str, help='file to create, ending in .gz, .xz or .zst')
+    parser.add_argument('--block-size', dest='block_size', type=float, default=1,
+                        help="Uncompressed size of each frame in MB (default 1)")
+    args = parser.parse_args()
+
+    if not compressed.is_compressed(args.outfile):
+        parser.error("outfile must end in one of %s" % ', '.join(sorted(compressed.CODECS)))
+    try:
+        compress = compressed.codec(args.outfile).compress
+    except compressed.CompressionError as e:
+        parser.error(str(e))
+    count = 0
+    with open(args.mbox, 'rb') as f, open(args.outfile + '.tmp', 'wb') as out:
+        for data in frames(f, int(args.block_size * 1024 * 1024)):
+            out.write(compress(data))
+            count += 1
+    os.replace(args.outfile + '.tmp', args.outfile)
+    print("Wrote %s: %u frame%s, %u bytes" % (args.outfile, count, 's' if count != 1 else '', os.path.getsize(args.outfile)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Generates a large synthetic mbox file for scale testing.
+
+The output depends only on the options (in particular --seed), so the same
+corpus can be regenerated anywhere instead of being stored. The messages are
+modelled on the quirks found in corpus/: ezmlm style From_ lines, folded
+Received headers, list headers, replies with References, multipart messages
+with the boundary on a continuation line, base64 attachments (including
+empty ones), HTML-only messages, format=flowed text, quoted-printable
+non-ASCII bodies and mboxo escaped '>From ' body lines. Optionally CRLF line
+endings and messages without Date or Message-ID headers.
+
+Usage: tools/generate-mbox.py [options] outfile
+
+e.g. tools/generate-mbox.py --size 500 --seed 1 /tmp/big.mbox
+Then create a spec from it with tests/test-generators.py or tests/test-parsing.py --generate.
+"""
+
+import argparse
+import base64
+import quopri
+import random
+import sys
+import time
+
+LISTS = [
+    ('dev', 'maven.apache.org', 'Maven Developers List'),
+    ('users', 'httpd.apache.org', 'Apache HTTP Server Users List'),
+    ('commits', 'ponymail.apache.org', None),
+    ('dev', 'asterixdb.apache.org', None),
+]
+
+NAMES = ['Alice Example', 'Bob Builder', 'Carol Tester', 'Dave Committer', 'Eve Reviewer', 'Frank Release',
+         'Grace Hopper', 'Heidi Ops', 'Ivan Pedersen', 'Judy Müller', 'Kenji Sato', 'Łukasz Nowak']
+
+WORDS = ('the a an to of and in is it that for on with as this be are was release build plugin version '
+         'maven archiver test vote pull request commit merge branch issue fix bug patch module dependency '
+         'repository staging artifact server config proxy module rewrite log error warning thanks regards '
+         'please could would should review change update upgrade java python mail list thread message').split()
+
+NON_ASCII = ['café', 'naïve', 'Grüße', 'über', 'señor', 'façade', 'smörgåsbord', '日本語', 'Ελληνικά', '€']
+
+ATTACHMENTS = [('application/pdf', 'report.pdf'), ('image/png', 'screenshot.png'),
+               ('application/octet-stream', 'build.zip'), ('text/x-log', 'build.log'),
+               ('application/x-patch', 'fix.patch')]
+
+START = 1483228800 # 2017-01-01
+
+
+def words(rng, count, non_ascii=False):
+    text = [rng.choice(WORDS) for _ in range(count)]
+    if non_ascii:
+        for _ in range(max(1, count // 20)):
+            text[rng.randrange(count)] = rng.choice(NON_ASCII)
+    return text
+
+
+def paragraphs(rng, count, width=72, non_ascii=False):
+    """Lines of wrapped text, with paragraphs separated by blank lines"""
+    lines = []
+    for p in range(count):
+        if p:
+            lines.append('')
+        line = ''
+        for word in words(rng, rng.randint(10, 120), non_ascii):
+            if line and len(line) + len(word) >= width:
+                lines.append(line)
+                line = word
+            else:
+                line = (line + ' ' + word) if line else word
+        lines.append(line)
+    return lines
+
+
+def date_header(ts, rng):
+    minutes = rng.choice([0, 0, 60, 120, -240, -420, 330]) # UTC offset
+    return time.strftime('%a, %d %b %Y %H:%M:%S', time.gmtime(ts + minutes * 60)) + \
+        ' %s%02u%02u' % ('-' if minutes < 0 else '+', abs(minutes) // 60, abs(minutes) % 60)
+
+
+class Generator(object):
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.ts = START
+        self.seq = 1000
+        self.recent = [] # (message-id, subject) of recent messages, for replies
+        self.boundaries = 0
+
+    def chance(self, pct):
+        return self.rng.random() * 100 < pct
+
+    def boundary(self):
+        self.boundaries += 1
+        return '----=_Part_%u_%u.%u' % (self.boundaries, self.rng.randrange(10**9), self.ts * 1000)
+
+    def text_body(self, non_ascii, quote):
+        """Returns (headers, lines) for a plain text body, quoting a previous message if quote is set"""
+        rng = self.rng
+        lines = paragraphs(rng, rng.randint(1, 6), non_ascii=non_ascii)
+        if quote:
+            lines = ['On %s, %s wrote:' % (time.strftime('%d/%m/%Y', time.gmtime(self.ts - 3600)), rng.choice(NAMES))] + \
+                ['> ' + line for line in paragraphs(rng, 1)] + [''] + lines
+        if self.chance(self.args.mangle):
+            # An mboxo body line starting with From, which must be escaped
+            lines.insert(rng.randrange(len(lines) + 1), '>From ' + ' '.join(words(rng, 8)))
+        if non_ascii:
+            encoded = quopri.encodestring('\n'.join(lines).encode('utf-8')).decode('ascii')
+            return ['Content-Type: text/plain; charset=UTF-8', 'Content-Transfer-Encoding: quoted-printable'], \
+                encoded.split('\n')
+        return ['Content-Type: text/plain; charset=us-ascii', 'Content-Transfer-Encoding: 7bit'], lines
+
+    def flowed_body(self):
+        rng = self.rng
+        lines = []
+        for line in paragraphs(rng, rng.randint(1, 4), width=rng.choice([60, 72, 78])):
+            lines.append(line + ' ' if line and rng.random() < 0.7 else line) # soft line breaks
+        lines[-1] = lines[-1].rstrip(' ')
+        delsp = '; delsp=yes' if self.chance(30) else ''
+        return ['Content-Type: text/plain; charset=UTF-8; format=flowed%s' % delsp,
+                'Content-Transfer-Encoding: 8bit'], lines
+
+    def html_only_body(self):
+        rng = self.rng
+        html = '<html><body>' + ''.join('<p>%s</p>' % ' '.join(words(rng, rng.randint(5, 60)))
+                                        for _ in range(rng.randint(1, 5))) + '<br><ul>' + \
+            ''.join('<li>"%s" = "%s"</li>' % (rng.choice(WORDS), rng.choice(WORDS)) for _ in range(3)) + \
+            '</ul></body></html>'
+        part = ['Content-Type: text/html;charset=UTF-8', 'Content-Transfer-Encoding: 7bit']
+        if self.chance(50):
+            return part, [html]
+        # Like the Nexus messages: a multipart/related with only an HTML part
+        boundary = self.boundary()
+        return ['Content-Type: multipart/related; ', '\tboundary="%s"' % boundary], \
+            ['', '--' + boundary] + part + ['', html, '--%s--' % boundary]
+
+    def attachment_body(self, non_ascii, quote):
+        rng = self.rng
+        boundary = self.boundary()
+        headers, text = self.text_body(non_ascii, quote)
+        lines = ['This is a multi-part message in MIME format.', '', '--' + boundary] + headers + [''] + text
+        for _ in range(rng.randint(1, 3)):
+            content_type, filename = rng.choice(ATTACHMENTS)
+            size = 0 if self.chance(5) else min(int(rng.paretovariate(1.2) * 1024), self.args.attachment_kb * 1024)
+            data = base64.encodebytes(rng.randbytes(size)).decode('ascii').rstrip('\n')
+            lines += ['', '--' + boundary, 'Content-Type: %s; name="%s"' % (content_type, filename),
+                      'Content-Transfer-Encoding: base64',
+                      'Content-Disposition: attachment; filename="%s"' % filename, '']
+            if data:
+                lines += data.split('\n')
+        lines += ['', '--%s--' % boundary]
+        return ['Content-Type: multipart/mixed;', '\tboundary="%s"' % boundary], lines
+
+    def message(self):
+        """Returns the lines of the next message, including the From_ line"""
+        rng = self.rng
+        args = self.args
+        self.ts += rng.randint(1, 3600)
+        self.seq += 1
+        local, domain, description = rng.choice(LISTS)
+        listaddr = '%s@%s' % (local, domain)
+        listid = '<%s.%s>' % (local, domain)
+        sender = rng.choice(NAMES)
+        envelope = '%s-return-%u-archive-asf-public=cust-asf.ponee.io@%s' % (local, self.seq, domain)
+        msgid = '<%u.%u.%u.JavaMail@%s>' % (self.ts, rng.randrange(10**6), rng.randrange(10**12), domain)
+        subject = ' '.join(words(rng, rng.randint(3, 10))).capitalize()
+        reply = self.recent and self.chance(50)
+        if reply:
+            parent, subject = rng.choice(self.recent)
+            subject = subject if subject.startswith('Re: ') else 'Re: ' + subject
+
+        lines = ['From %s %s%s' % (envelope, ' ' if self.chance(20) else '',
+                                   time.strftime('%a %b %d %H:%M:%S %Y', time.gmtime(self.ts))),
+                 'Return-Path: <%s>' % envelope,
+                 'Received: from mail.apache.org (hermes.apache.org [140.211.11.3])',
+                 '\tby cust-asf.ponee.io (Postfix) with SMTP id %X' % rng.randrange(16**9),
+                 '\tfor <archive-asf-public@cust-asf.ponee.io>; %s' % date_header(self.ts, rng),
+                 'Received: (qmail %u invoked by uid 500); %s' % (rng.randrange(10**5),
+                                                                   time.strftime('%d %b %Y %H:%M:%S -0000',
+                                                                                 time.gmtime(self.ts))),
+                 'Mailing-List: contact %s-help@%s; run by ezmlm' % (local, domain),
+                 'Precedence: bulk',
+                 'List-Help: <mailto:%s-help@%s>' % (local, domain),
+                 'List-Post: <mailto:%s>' % listaddr,
+                 'List-Id: %s' % ('"%s" %s' % (description, listid) if description else listid),
+                 'Delivered-To: mailing list %s' % listaddr]
+        if self.chance(10):
+            lines += ['X-Spam-Rating: %s 1.6.2 0/1000/N' % domain] * 2 # repeated headers
+        lines += ['From: %s <%s@example.org>' % (sender, sender.split()[0].lower()),
+                  'To: %s' % listaddr,
+                  'Subject: %s' % subject]
+        if not self.chance(args.no_date):
+            lines.append('Date: %s' % date_header(self.ts, rng))
+        if not self.chance(args.no_msgid):
+            lines.append('Message-ID: %s' % msgid)
+        if reply:
+            lines += ['In-Reply-To: %s' % parent, 'References: %s' % parent]
+
+        non_ascii = self.chance(15)
+        if self.chance(args.attachments):
+            headers, body = self.attachment_body(non_ascii, reply)
+        elif self.chance(args.html_only):
+            headers, body = self.html_only_body()
+        elif self.chance(args.flowed):
+            headers, body = self.flowed_body()
+        else:
+            headers, body = self.text_body(non_ascii, reply)
+        self.recent = (self.recent + [(msgid, subject)])[-50:]
+        return lines + ['MIME-Version: 1.0'] + headers + [''] + body + ['']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic mbox file for scale testing.')
+    parser.add_argument('outfile', type=str, help='mbox file to create')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='Random seed; the same options always give the same file (default 0)')
+    parser.add_argument('--size', dest='size', type=float, default=100,
+                        help='Approximate size of the file in MB (default 100)')
+    parser.add_argument('--count', dest='count', type=int,
+                        help='Number of messages to write instead of --size')
+    parser.add_argument('--attachments', dest='attachments', type=float, default=10,
+                        help='Percentage of messages with attachments (default 10)')
+    parser.add_argument('--attachment-kb', dest='attachment_kb', type=int, default=512,
+                        help='Maximum size of an attachment in KB (default 512)')
+    parser.add_argument('--html-only', dest='html_only', type=float, default=5,
+                        help='Percentage of the remaining messages that only have an HTML part (default 5)')
+    parser.add_argument('--flowed', dest='flowed', type=float, default=10,
+                        help='Percentage of the remaining messages that are format=flowed (default 10)')
+    parser.add_argument('--mangle', dest='mangle', type=float, default=2,
+                        help="Percentage of text parts with a mboxo escaped '>From ' line (default 2)")
+    parser.add_argument('--no-date', dest='no_date', type=float, default=1,
+                        help='Percentage of messages without a Date header (default 1)')
+    parser.add_argument('--no-msgid', dest='no_msgid', type=float, default=1,
+                        help='Percentage of messages without a Message-ID header (default 1)')
+    parser.add_argument('--crlf', dest='crlf', action='store_true',
+                        help='Use CRLF line endings')
+    args = parser.parse_args()
+
+    generator = Generator(args)
+    eol = '\r\n' if args.crlf else '\n'
+    limit = args.size * 1024 * 1024
+    written = 0
+    count = 0
+    with open(args.outfile, 'wb') as f:
+        while (count < args.count) if args.count is not None else (written < limit):
+            data = (eol.join(generator.message()) + eol).encode('utf-8')
+            f.write(data)
+            written += len(data)
+            count += 1
+    print("Wrote %u emails (%.1f MB) to %s" % (count, written / 1048576.0, args.outfile), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
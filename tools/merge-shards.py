@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Merges the --json reports of a suite run split with runall.py --shard I/N.
+
+Prints the same totals as a single runall.py run of the whole suite and exits
+with the same status: -1 if any test type of any spec failed on any shard.
+A spec split across shards counts once, and fails if any of its parts failed.
+The reports of all N shards must be given; the merged tests are listed in shard order.
+
+Usage: tools/merge-shards.py [--json FILE] [--junit FILE] shard1.json ... shardN.json
+"""
+
+import argparse
+import collections
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests'))
+import results # pylint: disable=wrong-import-position
+
+
+def load(filenames):
+    """Returns the reports in shard order, or exits if any shard is missing"""
+    reports = {}
+    count = None
+    for filename in filenames:
+        with open(filename) as f:
+            report = json.load(f)
+        if 'shard' not in report or 'specs' not in report:
+            sys.exit("%s is not the --json report of a runall.py --shard run" % filename)
+        i, n = report['shard']
+        if count is not None and n != count:
+            sys.exit("%s is from a run split into %u shards, not %u" % (filename, n, count))
+        if i in reports:
+            sys.exit("%s is a second report of shard %u/%u" % (filename, i, n))
+        count = n
+        reports[i] = report
+    missing = [str(i) for i in range(1, (count or 0) + 1) if i not in reports]
+    if missing:
+        sys.exit("Missing the reports of shard%s %s of %u" % ('s' if len(missing) != 1 else '', ', '.join(missing), count))
+    return [reports[i] for i in sorted(reports)]
+
+
+def merge(reports):
+    """Returns (totals, outcome of each test type of each spec, test records)"""
+    specs = collections.OrderedDict()
+    for report in reports:
+        for part in report['specs']:
+            key = (part['spec'], part['type'])
+            if key not in specs:
+                specs[key] = dict(part)
+                continue
+            merged = specs[key]
+            for count in ('tests', 'failed', 'skipped'):
+                merged[count] += part[count]
+            if merged['returncode'] == 0:
+                merged['returncode'] = part['returncode']
+    merged_specs = list(specs.values())
+    tests = sum(s['tests'] for s in merged_specs)
+    failed = sum(s['failed'] for s in merged_specs)
+    totals = {'specs': len(merged_specs), 'run': tests, 'succeeded': tests - failed, 'failed': failed,
+              'skipped': sum(s['skipped'] for s in merged_specs),
+              'seconds': max(report['totals'].get('seconds', 0) for report in reports)} # the shards run side by side
+    return totals, merged_specs, [record for report in reports for record in report['tests']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the --json reports of runall.py --shard runs.')
+    parser.add_argument('--json', dest='json', type=str, action='store',
+                        help="Write the merged JSON report to this file")
+    parser.add_argument('--junit', dest='junit', type=str, action='store',
+                        help="Write a JUnit XML report of every test to this file")
+    parser.add_argument('reports', nargs='+', help="The --json report of each shard")
+    args = parser.parse_args()
+
+    totals, specs, records = merge(load(args.reports))
+    if args.junit:
+        results.write_junit(args.junit, records)
+    if args.json:
+        results.write_json(args.json, records, totals, specs)
+    for spec in specs:
+        if spec['returncode'] != 0:
+            print("FAIL: %s test from %s failed with code %d" % (spec['type'], spec['spec'], spec['returncode']),
+                  file=sys.stderr)
+    results.summary(totals, totals['seconds'])
+    if any(spec['returncode'] != 0 for spec in specs):
+        sys.exit(-1)
+
+
+if __name__ == '__main__':
+    main()
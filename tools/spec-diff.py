@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Compares the IDs in generator specs by message-id, to see which generators give
+the same message different IDs depending on where it was archived from (e.g.
+gen-maven-dev-2017-11-{listsao,mailarchivesao,mboxvm}) or on the Pony Mail
+version (specs generated with different versions, or the per-version
+overrides within a spec).
+
+Each mbox of each spec is a source. The entries of the specs are read one at a
+time (see tests/yaml_stream.py) and hash-joined on generator and message-id,
+keeping only the IDs, so this works for specs of any size and for sources
+holding different sets of messages, unlike diffing the output of
+tools/yaml_sort.py. With --versions, each source is compared once for each
+version, using the ID the tests expect for it (the override for the version
+if there is one, otherwise 'generated').
+
+Usage: tools/spec-diff.py [--versions V [V ...]] [--generators G [G ...]] [--examples N] spec.yaml ...
+
+e.g. tools/spec-diff.py yaml/gen-maven-dev-2017-11-*.yaml
+Exits with -1 if any message has different IDs.
+"""
+
+import argparse
+import collections
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests'))
+import yaml_stream # pylint: disable=wrong-import-position
+
+
+class Join(object):
+    """The IDs of each (generator, message-id) from every source"""
+    def __init__(self, versions=None, generators=None):
+        self.versions = versions or [None]
+        self.generators = generators
+        self.columns = [] # (spec, mbox, version) for each source and version
+        self.column_ids = {}
+        self.rows = {} # (generator, message-id) -> [ID or None for each column]
+        self.gen_columns = collections.defaultdict(set) # generator -> columns which have it
+        self.entries = collections.Counter() # column -> entries read
+        self.duplicates = collections.Counter() # column -> entries repeating a message-id
+        self.no_msgid = collections.Counter() # column -> entries without a message-id
+
+    def _columns(self, spec, mbox):
+        key = (spec, mbox)
+        if key not in self.column_ids:
+            self.column_ids[key] = len(self.columns)
+            self.columns.extend((spec, mbox, version) for version in self.versions)
+        first = self.column_ids[key]
+        return range(first, first + len(self.versions))
+
+    def add(self, spec):
+        """Reads the generator entries of a spec file"""
+        with open(spec, 'r') as f:
+            for keys, entry in yaml_stream.entries(f):
+                if len(keys) != 3 or keys[0] != 'generators' or not isinstance(entry, dict):
+                    continue
+                _, mbox, gen_type = keys
+                if self.generators and gen_type not in self.generators:
+                    continue
+                msgid = entry.get('message-id')
+                for column, version in zip(self._columns(spec, mbox), self.versions):
+                    self.gen_columns[gen_type].add(column)
+                    self.entries[column] += 1
+                    if not msgid:
+                        self.no_msgid[column] += 1
+                        continue
+                    row = self.rows.get((gen_type, msgid))
+                    if row is None:
+                        row = self.rows[(sys.intern(gen_type), msgid)] = []
+                    if len(row) <= column:
+                        row.extend([None] * (column + 1 - len(row)))
+                    if row[column] is not None:
+                        self.duplicates[column] += 1 # keep the first, as the message-id is ambiguous anyway
+                        continue
+                    row[column] = entry.get(version, entry.get('generated')) # as the tests expect for the version
+
+    def compare(self):
+        """Returns {generator: (messages, in all its sources, differing [(message-id, row)])}"""
+        stats = {}
+        for (gen_type, msgid), row in self.rows.items():
+            columns = self.gen_columns[gen_type]
+            ids = [row[column] for column in columns if column < len(row) and row[column] is not None]
+            gen_stats = stats.setdefault(gen_type, [0, 0, []])
+            gen_stats[0] += 1
+            if len(ids) == len(columns):
+                gen_stats[1] += 1
+            if len(set(ids)) > 1:
+                gen_stats[2].append((msgid, row))
+        return stats
+
+    def label(self, column):
+        spec, mbox, version = self.columns[column]
+        return "%s: %s%s" % (spec, mbox, ' (%s)' % version if version else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the IDs of generator specs by message-id.')
+    parser.add_argument('specs', nargs='+', help='generator spec files')
+    parser.add_argument('--versions', dest='versions', type=str, nargs='+',
+                        help="Compare the IDs expected for each of these Pony Mail versions (e.g. v0.10 foal)")
+    parser.add_argument('--generators', dest='generators', type=str, nargs='+',
+                        help="Only compare these generators")
+    parser.add_argument('--examples', dest='examples', type=int, default=5,
+                        help="Number of differing messages to list per generator (default 5)")
+    args = parser.parse_args()
+
+    join = Join(args.versions, args.generators)
+    for spec in args.specs:
+        join.add(spec)
+    stats = join.compare()
+
+    print("Sources:")
+    for column in range(len(join.columns)):
+        extra = ''.join(", %u %s" % (count, what) for count, what in
+                        ((join.duplicates[column], 'duplicate message-ids'),
+                         (join.no_msgid[column], 'without message-id')) if count)
+        print("  [%u] %s (%u entries%s)" % (column + 1, join.label(column), join.entries[column], extra))
+    print()
+    print("%-10s %8s %10s %8s %8s %8s" % ('generator', 'sources', 'messages', 'in all', 'in some', 'differ'))
+    differing = 0
+    for gen_type in sorted(stats):
+        messages, in_all, differ = stats[gen_type]
+        print("%-10s %8u %10u %8u %8u %8u" % (gen_type, len(join.gen_columns[gen_type]), messages, in_all,
+                                              messages - in_all, len(differ)))
+        differing += len(differ)
+    for gen_type in sorted(stats):
+        differ = stats[gen_type][2]
+        if not differ or not args.examples:
+            continue
+        print()
+        print("%s: %u message%s with different IDs%s" % (gen_type, len(differ), 's' if len(differ) != 1 else '',
+                                                         ', e.g.' if len(differ) > args.examples else ''))
+        for msgid, row in sorted(differ, key=lambda item: item[0])[:args.examples]:
+            print("  %s" % msgid)
+            for column in sorted(join.gen_columns[gen_type]):
+                value = row[column] if column < len(row) else None
+                print("    [%u] %s" % (column + 1, '(missing)' if value is None else value))
+    if differing:
+        sys.exit(-1)
+
+
+if __name__ == '__main__':
+    main()